@@ -2,6 +2,12 @@ import maya.api.OpenMaya as om
 import maya.cmds as cmds
 import math
 import random
+from multiprocessing.pool import ThreadPool
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 def maya_useNewAPI():
     """
@@ -37,10 +43,158 @@ class DynamicalState:
         self.expand_to(self.accel, add_size)
         self.nb_items += nb
 
+class ArrayDynamicalState(object):
+    """
+    Structure-of-arrays version of DynamicalState. pos, vel and accel are (N, 3)
+    views onto contiguous NumPy storage that grows geometrically, so adding
+    boids is amortized constant time and no per-boid objects are allocated.
+
+    Each slot holds a boid with a stable id. Killed boids leave dead slots on a
+    free-list that emit() reuses, and compact() packs the live boids to the
+    front once enough slots are dead.
+    """
+    ARRAYS = (('_pos', 3, 'float32'), ('_vel', 3, 'float32'), ('_accel', 3, 'float32'),
+              ('_ids', 0, 'int64'), ('_alive', 0, 'bool'), ('_age', 0, 'float32'), ('_lifespan', 0, 'float32'),
+              ('_flock', 0, 'int32'))
+
+    def __init__(self, nb=0):
+        self.nb_items = 0
+        self.capacity = 0
+        for name, width, dtype in self.ARRAYS:
+            setattr(self, name, np.zeros((0, width) if width else 0, dtype=dtype))
+        self.free = []
+        self.slots = {}
+        self.next_id = 0
+        # Bumped whenever boids are emitted, killed or moved between slots
+        self.version = 0
+        self.add(nb)
+
+    @property
+    def pos(self):
+        return self._pos[:self.nb_items]
+
+    @property
+    def vel(self):
+        return self._vel[:self.nb_items]
+
+    @property
+    def accel(self):
+        return self._accel[:self.nb_items]
+
+    @property
+    def ids(self):
+        return self._ids[:self.nb_items]
+
+    @property
+    def alive(self):
+        return self._alive[:self.nb_items]
+
+    @property
+    def age(self):
+        return self._age[:self.nb_items]
+
+    @property
+    def lifespan(self):
+        return self._lifespan[:self.nb_items]
+
+    @property
+    def flock(self):
+        return self._flock[:self.nb_items]
+
+    @property
+    def live_count(self):
+        return self.nb_items - len(self.free)
+
+    def reserve(self, n):
+        if n <= self.capacity:
+            return
+        capacity = max(n, 2 * self.capacity, 16)
+        for name, width, dtype in self.ARRAYS:
+            data = np.zeros((capacity, width) if width else capacity, dtype=dtype)
+            data[:self.nb_items] = getattr(self, name)[:self.nb_items]
+            setattr(self, name, data)
+        self.capacity = capacity
+
+    def add(self, nb):
+        self.emit(nb)
+
+    def emit(self, nb, pos=None, vel=None, lifespan=None, flock=0):
+        """
+        Adds nb live boids, filling dead slots first, and returns their new ids.
+        A lifespan of None lets them live forever.
+        """
+        if lifespan is None:
+            lifespan = np.inf
+        reuse = min(nb, len(self.free))
+        slots = [self.free.pop() for i in range(reuse)]
+        first = self.nb_items
+        self.reserve(first + nb - reuse)
+        self.nb_items += nb - reuse
+        slots = np.array(slots + list(range(first, self.nb_items)), dtype=np.int64)
+
+        ids = np.arange(self.next_id, self.next_id + nb, dtype=np.int64)
+        self.next_id += nb
+        self._ids[slots] = ids
+        self._alive[slots] = True
+        self._age[slots] = 0.0
+        self._lifespan[slots] = lifespan
+        self._flock[slots] = flock
+        self._pos[slots] = 0.0 if pos is None else pos
+        self._vel[slots] = np.random.uniform(-1.0, 1.0, (nb, 3)) if vel is None else vel
+        self._accel[slots] = 0.0
+        self.slots.update(zip(ids.tolist(), slots.tolist()))
+        self.version += 1
+        return ids
+
+    def kill(self, ids):
+        slots = [self.slots.pop(i) for i in ids if i in self.slots]
+        if not slots:
+            return
+        self._alive[slots] = False
+        self._vel[slots] = 0.0
+        self._accel[slots] = 0.0
+        self.free.extend(slots)
+        self.version += 1
+
+    def slot_of(self, boid_id):
+        return self.slots.get(boid_id, -1)
+
+    def compact(self):
+        """
+        Packs the live boids into the leading slots, keeping their order.
+        """
+        live = np.flatnonzero(self.alive)
+        for name, width, dtype in self.ARRAYS:
+            data = getattr(self, name)
+            data[:len(live)] = data[live]
+        self.nb_items = len(live)
+        self.free = []
+        self.slots = dict(zip(self.ids.tolist(), range(self.nb_items)))
+        self.version += 1
+
+    def maybe_compact(self, threshold=0.25):
+        if self.free and len(self.free) > threshold * self.nb_items:
+            self.compact()
+
+    def to_vectors(self, slots=None):
+        # Copy into a list-backed state for code working on MFloatVectors
+        if slots is None:
+            slots = slice(0, self.nb_items)
+        pq = DynamicalState()
+        pq.pos = [om.MFloatVector(*p) for p in self._pos[slots].tolist()]
+        pq.vel = [om.MFloatVector(*v) for v in self._vel[slots].tolist()]
+        pq.accel = [om.MFloatVector(*a) for a in self._accel[slots].tolist()]
+        pq.nb_items = len(pq.pos)
+        return pq
+
 class AdvancePosition:
     def __init__(self, pq):
         self.PQ = pq  #type: DynamicalState
     def solve(self, dt):
+        if isinstance(self.PQ, ArrayDynamicalState):
+            self.PQ.pos[:] += self.PQ.vel * dt
+            return
+
         # update position
         for i in range(self.PQ.nb_items):
             self.PQ.pos[i] += self.PQ.vel[i] * dt
@@ -54,12 +208,368 @@ class AdvancedVelocity:
         self.force.compute(self.PQ, dt)
 
         # update velocity
+        if isinstance(self.PQ, ArrayDynamicalState):
+            self.PQ.vel[:] += self.PQ.accel * dt
+            return
         for i in range(self.PQ.nb_items):
             self.PQ.vel[i] += self.PQ.accel[i] * dt
 
+class BoidIntegrator:
+    """
+    Advances the state by a frame step split into substeps with one of SCHEMES.
+    Velocity Verlet and RK2 need an ArrayDynamicalState, a list-backed state
+    always uses symplectic Euler.
+    """
+    SCHEMES = ("euler", "verlet", "rk2")
+
+    def __init__(self, pq, f, scheme="euler"):
+        self.PQ = pq  #type: ArrayDynamicalState
+        self.force = f  #type: BoidForce
+        self.scheme = scheme
+        self.positionSolve = AdvancePosition(pq)
+        self.velocitySolve = AdvancedVelocity(pq, f)
+        self._primed = False
+
+    def solve(self, dt, substeps=1):
+        scheme = self.scheme
+        if not isinstance(self.PQ, ArrayDynamicalState):
+            scheme = "euler"
+        step = getattr(self, "step_" + scheme)
+        h = dt / substeps
+        for i in range(substeps):
+            step(h)
+
+    def step_euler(self, dt):
+        # Symplectic Euler: drift, then kick with the force at the new position
+        self.positionSolve.solve(dt)
+        self.velocitySolve.solve(dt)
+        self._primed = True
+
+    def step_verlet(self, dt):
+        pq = self.PQ
+        if not self._primed:
+            self.force.compute(pq, dt)
+            self._primed = True
+        # Half kick and drift with the previous acceleration, then half kick with the new one
+        pq.vel[:] += pq.accel * (0.5 * dt)
+        pq.pos[:] += pq.vel * dt
+        self.force.compute(pq, dt)
+        pq.vel[:] += pq.accel * (0.5 * dt)
+
+    def step_rk2(self, dt):
+        pq = self.PQ
+        x0 = pq.pos.copy()
+        v0 = pq.vel.copy()
+        # Midpoint state from the acceleration at the start of the step
+        self.force.compute(pq, dt)
+        pq.pos[:] += v0 * (0.5 * dt)
+        pq.vel[:] += pq.accel * (0.5 * dt)
+        self.force.compute(pq, dt)
+        pq.pos[:] = x0 + pq.vel * dt
+        pq.vel[:] = v0 + pq.accel * dt
+        self._primed = True
+
+class SpatialHashGrid:
+    """
+    Uniform hash grid bucketing boids by cell so a neighbor query only visits
+    the boid's own cell and the 26 cells around it.
+    """
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def cell_of(self, p):
+        inv = 1.0 / self.cell_size
+        return (int(math.floor(p.x * inv)), int(math.floor(p.y * inv)), int(math.floor(p.z * inv)))
+
+    def build(self, points, count):
+        self.cells = {}
+        for i in range(count):
+            self.cells.setdefault(self.cell_of(points[i]), []).append(i)
+
+    def neighbors(self, p):
+        cx, cy, cz = self.cell_of(p)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    bucket = self.cells.get((cx + dx, cy + dy, cz + dz))
+                    if bucket:
+                        for i in bucket:
+                            yield i
+
+class VerletNeighborList(object):
+    """
+    Cached neighbor pairs of every boid within range_ramp + skin, stored sorted
+    by boid with per-boid offsets. The pairs stay valid until some boid has
+    moved more than half the skin since they were built.
+    """
+    def __init__(self, skin):
+        self.skin = skin
+        self.cutoff = 0.0
+        self.rebuilds = 0
+        self.steps = 0
+        self.ref_pos = None
+        self.rows = None
+        self.cols = None
+        self.offsets = None
+        self.version = None
+
+    def update(self, pos, range_ramp, alive=None, version=None):
+        self.steps += 1
+        cutoff = range_ramp + self.skin
+        if not self.needs_rebuild(pos, cutoff, version):
+            return False
+        self.build(pos, cutoff, alive)
+        self.version = version
+        self.rebuilds += 1
+        return True
+
+    def needs_rebuild(self, pos, cutoff, version=None):
+        if self.ref_pos is None or len(self.ref_pos) != len(pos) or cutoff != self.cutoff:
+            return True
+        # Boids were emitted, killed or compacted
+        if version != self.version:
+            return True
+        moved = pos - self.ref_pos
+        return np.einsum('nk,nk->n', moved, moved).max() > (0.5 * self.skin) ** 2
+
+    def build(self, pos, cutoff, alive=None):
+        rows, cols = self.grid_pairs(pos, cutoff)
+        d = pos[cols] - pos[rows]
+        keep = np.einsum('nk,nk->n', d, d) < cutoff * cutoff
+        if alive is not None:
+            keep &= alive[rows] & alive[cols]
+        rows = rows[keep]
+        cols = cols[keep]
+        order = np.argsort(rows, kind='mergesort')
+        self.rows = rows[order]
+        self.cols = cols[order]
+        self.offsets = np.searchsorted(self.rows, np.arange(len(pos) + 1))
+        self.ref_pos = pos.copy()
+        self.cutoff = cutoff
+
+    @staticmethod
+    def grid_pairs(pos, cell_size):
+        """
+        Candidate pairs (i, j), i != j, of boids in the same or adjacent cells of
+        a uniform grid, found with sorted cell keys instead of a per-boid loop.
+        """
+        n = len(pos)
+        cells = np.floor(pos / cell_size).astype(np.int64)
+        # Pad by one cell on each side so neighbor keys never wrap into another row
+        cells -= cells.min(axis=0) - 1
+        dims = cells.max(axis=0) + 2
+        key = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+        order = np.argsort(key, kind='mergesort')
+        sorted_key = key[order]
+
+        rows = []
+        cols = []
+        boids = np.arange(n)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    nkey = key + (dx * dims[1] + dy) * dims[2] + dz
+                    start = np.searchsorted(sorted_key, nkey, 'left')
+                    count = np.searchsorted(sorted_key, nkey, 'right') - start
+                    total = count.sum()
+                    if total == 0:
+                        continue
+                    first = np.repeat(np.cumsum(count) - count, count)
+                    rows.append(np.repeat(boids, count))
+                    cols.append(order[np.repeat(start, count) + np.arange(total) - first])
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        other = rows != cols
+        return rows[other], cols[other]
+
+def trilinear(grid, origin, cell, points):
+    """
+    Trilinear interpolation of grid values shaped (nx, ny, nz, channels), with
+    lower corner origin and per-axis cell size, at points shaped (n, 3). Points
+    outside the grid read the nearest boundary value.
+    """
+    shape = np.array(grid.shape[:3])
+    u = np.clip((points - origin) / cell, 0.0, shape - 1)
+    i0 = np.minimum(np.floor(u).astype(np.int64), np.maximum(shape - 2, 0))
+    f = u - i0
+    result = np.zeros((len(points),) + grid.shape[3:], dtype=np.float32)
+    for dx in (0, 1):
+        wx = f[:, 0] if dx else 1.0 - f[:, 0]
+        for dy in (0, 1):
+            wy = f[:, 1] if dy else 1.0 - f[:, 1]
+            for dz in (0, 1):
+                wz = f[:, 2] if dz else 1.0 - f[:, 2]
+                corner = grid[np.minimum(i0[:, 0] + dx, shape[0] - 1),
+                              np.minimum(i0[:, 1] + dy, shape[1] - 1),
+                              np.minimum(i0[:, 2] + dz, shape[2] - 1)]
+                w = wx * wy * wz
+                result += w.reshape((-1,) + (1,) * (corner.ndim - 1)) * corner
+    return result
+
+class GoalFlowField(object):
+    """
+    Unit directions toward the goals, dominated by the nearest one, sampled on a
+    grid spanning the goals plus extent. The grid is rebuilt only when the goals
+    or its layout change, after which steering costs one lookup per boid no
+    matter how many goals there are.
+    """
+    def __init__(self):
+        self.goals = None
+        self.key = None
+        self.grid = None
+        self.origin = None
+        self.cell = None
+        self.builds = 0
+
+    def update(self, goals, extent, resolution):
+        goals = np.asarray(goals, dtype=np.float32).reshape(-1, 3)
+        key = (extent, resolution)
+        if self.grid is not None and key == self.key and np.array_equal(goals, self.goals):
+            return False
+        self.build(goals, extent, max(2, resolution))
+        self.goals = goals
+        self.key = key
+        self.builds += 1
+        return True
+
+    def build(self, goals, extent, resolution):
+        lo = goals.min(axis=0) - extent
+        hi = goals.max(axis=0) + extent
+        self.origin = lo
+        self.cell = np.maximum((hi - lo) / (resolution - 1), 1e-6)
+        axes = [lo[k] + self.cell[k] * np.arange(resolution, dtype=np.float32) for k in range(3)]
+        points = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+
+        # Sum of unit directions weighted by 1 / r^2, so the nearest goal dominates
+        field = np.zeros_like(points)
+        for goal in goals:
+            d = goal - points
+            r2 = np.einsum('nk,nk->n', d, d)
+            field += d / (r2 ** 1.5 + 1e-6)[:, np.newaxis]
+        self.grid = self.normalize(field).reshape(resolution, resolution, resolution, 3)
+
+    def sample(self, points):
+        return self.normalize(trilinear(self.grid, self.origin, self.cell, points))
+
+    @staticmethod
+    def normalize(v):
+        length = np.sqrt(np.einsum('nk,nk->n', v, v))
+        return v / np.where(length > 0.0, length, 1.0)[:, np.newaxis]
+
+class SignedDistanceGrid(object):
+    """
+    Signed distance to a mesh, negative inside, sampled on a grid over the mesh
+    bounds plus padding, with its gradient precomputed by central differences.
+    Built once per mesh change, a boid then needs one lookup for its distance
+    and push direction instead of a test against every triangle.
+    """
+    def __init__(self):
+        self.key = None
+        self.grid = None
+        self.gradient = None
+        self.origin = None
+        self.cell = None
+
+    def build(self, mesh, padding, resolution):
+        resolution = max(2, resolution)
+        points = om.MFnMesh(mesh).getPoints(om.MSpace.kObject)
+        points = np.array([(p.x, p.y, p.z) for p in points], dtype=np.float32)
+        lo = points.min(axis=0) - padding
+        hi = points.max(axis=0) + padding
+        self.origin = lo
+        self.cell = np.maximum((hi - lo) / (resolution - 1), 1e-6)
+
+        intersector = om.MMeshIntersector()
+        intersector.create(mesh, om.MMatrix())
+        axes = [(lo[k] + self.cell[k] * np.arange(resolution)).tolist() for k in range(3)]
+        grid = np.zeros((resolution, resolution, resolution), dtype=np.float32)
+        for i, x in enumerate(axes[0]):
+            for j, y in enumerate(axes[1]):
+                for k, z in enumerate(axes[2]):
+                    closest = intersector.getClosestPoint(om.MPoint(x, y, z))
+                    offset = om.MVector(x - closest.point.x, y - closest.point.y, z - closest.point.z)
+                    distance = offset.length()
+                    # Inside when the closest face points away from the sample
+                    grid[i, j, k] = -distance if offset * om.MVector(closest.normal) < 0.0 else distance
+        self.grid = grid
+        self.gradient = np.stack(np.gradient(grid, *self.cell.tolist()), axis=-1).astype(np.float32)
+
+    def sample(self, points):
+        distance = trilinear(self.grid[..., np.newaxis], self.origin, self.cell, points)[:, 0]
+        return distance, trilinear(self.gradient, self.origin, self.cell, points)
+
+class BoidLOD(object):
+    """
+    Update rates of boids by distance from a viewer. Boids within near are
+    evaluated every step, up to far every reduced_rate steps, and beyond far or
+    with almost no acceleration every sleep_rate steps. Skipped boids keep their
+    last acceleration and the integrator extrapolates them in between.
+    """
+    def __init__(self):
+        self.center = np.zeros(3, dtype=np.float32)
+        self.near = 20.0
+        self.far = 60.0
+        self.reduced_rate = 2
+        self.sleep_rate = 8
+        self.sleep_accel = 1e-3
+        self.step = 0
+        self.version = None
+        # Live boids in the full, reduced and sleeping tiers at the last step
+        self.counts = (0, 0, 0)
+
+    def select(self, pq, leads):
+        alive = pq.alive
+        d = pq.pos - self.center
+        d2 = np.einsum('nk,nk->n', d, d)
+        tier = np.where(d2 < self.near * self.near, 0, np.where(d2 < self.far * self.far, 1, 2))
+        a2 = np.einsum('nk,nk->n', pq.accel, pq.accel)
+        tier[a2 < self.sleep_accel * self.sleep_accel] = 2
+        tier[leads] = 0
+        self.counts = tuple(np.bincount(tier[alive], minlength=3).tolist())
+
+        if pq.version != self.version:
+            # New boids have no acceleration yet, evaluate everyone once
+            self.version = pq.version
+            due = alive
+        else:
+            # Staggered by id so each tier's work is spread over its period
+            rate = np.array([1, max(1, self.reduced_rate), max(1, self.sleep_rate)])[tier]
+            due = alive & ((self.step + pq.ids) % rate == 0)
+        self.step += 1
+        return np.flatnonzero(due)
+
 class BoidForce:
     leadBoid_index = 0
     leadBoid_goal = None
+    # Visit every boid instead of the hash grid cells / neighbor lists, for checking their results
+    brute_force = False
+    # "numpy" runs ArrayDynamicalState through the block kernel, "python" through the per-boid loop
+    backend = "numpy"
+    # Upper bound in bytes on the pairwise temporaries of one kernel block
+    memory_budget = 64 * 1024 * 1024
+    # Threads splitting the boid range in the NumPy kernel
+    workers = 1
+    # One worker pool shared by every node, grown to the most workers asked for
+    # and closed with close_pool() when the plug-in unloads
+    _pool = None
+    _pool_size = 0
+    # Scale of the avoidance between boids of different flocks, 0 lets flocks pass through each other
+    cross_avoid = 0.0
+    # Ids of additional leaders steering like leadBoid_index
+    leaders = ()
+    # GoalFlowField replacing leadBoid_goal in the NumPy backend, None to steer straight at the goal
+    goal_field = None
+    # Lowest priority acceleration of every boid along the goal field
+    goal_weight = 0.0
+    # BoidLOD picking the boids evaluated each step, None to evaluate all of them
+    lod = None
+    # SignedDistanceGrid obstacles, pushed away from within obstacle_range of their surface
+    obstacles = ()
+    obstacle_range = 2.0
+    obstacle_strength = 10.0
 
     def __init__(self, a, v, c, Max, rng, rng_ramp=1.0):
         self.A = a
@@ -72,73 +582,333 @@ class BoidForce:
         self.dfov = 10.0
         self.cosfov = math.cos(self.fov * 3.14159265 / 360.0)
         self.cosfovshell = math.cos(self.dfov * 3.14159265 / 360.0)
+        # Rows of (a, v, c, Max, rng, rng_ramp, fov) per flock id, None for a single flock
+        self.flocks = None
+        self.grid = SpatialHashGrid(rng_ramp)
+        self.neighbors = VerletNeighborList(0.5)
 
     def compute(self, pq, dt):
-        for boid in range(pq.nb_items):
-            kr = 0.0; kf = 0.0
-            a_avoid = om.MFloatVector(0.0, 0.0, 0.0); a_velMat = om.MFloatVector(0.0, 0.0, 0.0); a_center = om.MFloatVector(0.0, 0.0, 0.0)
-            _amax = self.amax
+        if isinstance(pq, ArrayDynamicalState):
+            if self.backend == "numpy":
+                self.compute_array(pq, dt)
+                return
+            # The per-boid loop works on MFloatVectors, so run it on a copy of the live boids
+            live = np.flatnonzero(pq.alive)
+            vectors = pq.to_vectors(live)
+            lead = pq.slot_of(self.leadBoid_index)
+            lead = int(np.searchsorted(live, lead)) if lead >= 0 else -1
+            self.compute_vectors(vectors, lead)
+            pq.accel[:] = 0.0
+            pq.accel[live] = [(a.x, a.y, a.z) for a in vectors.accel]
+            return
+        self.compute_vectors(pq, self.leadBoid_index)
+
+    def compute_vectors(self, pq, lead):
+        if not self.brute_force:
+            # Neighbors beyond range_ramp have no influence, so cells of that size cover them all
+            self.grid.cell_size = self.range_ramp
+            self.grid.build(pq.pos, pq.nb_items)
 
+        for boid in range(pq.nb_items):
             # If the boid is the leader
-            if boid == self.leadBoid_index:
+            if boid == lead:
                 boid_dir = (self.leadBoid_goal - pq.pos[boid]).normal()
                 pq.accel[boid] = boid_dir * self.amax
                 continue
 
-            for neighbor in range(pq.nb_items):
-                if neighbor == boid:
-                    continue
-                xa = pq.pos[boid]  #type: om.MFloatVector
-                xb = pq.pos[neighbor]  #type: om.MFloatVector
-                va = pq.vel[boid]  #type: om.MFloatVector
-                vb = pq.vel[neighbor]  #type: om.MFloatVector
-
-                # Influence Range
-                r = (xa - xb).length()
-                if r < self.range:
-                    kr = 1
-                elif r > self.range and r < self.range_ramp:
-                    kr = (self.range_ramp - r) / (self.range_ramp - self.range)
-                elif r > self.range_ramp:
-                    kr = 0
-
-                # Influence FOV
-                t = (xb - xa).normalize() * va.normal()
-                if t > self.cosfovshell:
-                    kf = 1
-                elif t > self.cosfov and t < self.cosfovshell:
-                    kf = (self.cosfov - t) / (self.cosfov - self.cosfovshell)
-                elif t < self.cosfov:
-                    kf = 0
+            if self.brute_force:
+                neighbors = range(pq.nb_items)
+            else:
+                neighbors = self.grid.neighbors(pq.pos[boid])
+            pq.accel[boid] = self.steer(pq, boid, neighbors)
 
-                # Avoidance
-                a_avoid += (self.A * (xa - xb).normalize() * (1 / (xa - xb).length()) * kr * kf)  #type: om.MFloatVector
-                # Velocity Matching
-                a_velMat += (self.V * (vb - va) * kr * kf)
-                # Centering
-                a_center += (self.C * (xb - xa) * kr * kf)
+    def steer(self, pq, boid, neighbors):
+        kr = 0.0; kf = 0.0
+        a_avoid = om.MFloatVector(0.0, 0.0, 0.0); a_velMat = om.MFloatVector(0.0, 0.0, 0.0); a_center = om.MFloatVector(0.0, 0.0, 0.0)
+
+        for neighbor in neighbors:
+            if neighbor == boid:
+                continue
+            xa = pq.pos[boid]  #type: om.MFloatVector
+            xb = pq.pos[neighbor]  #type: om.MFloatVector
+            va = pq.vel[boid]  #type: om.MFloatVector
+            vb = pq.vel[neighbor]  #type: om.MFloatVector
+
+            # Influence Range
+            r = (xa - xb).length()
+            if r < self.range:
+                kr = 1
+            elif r > self.range and r < self.range_ramp:
+                kr = (self.range_ramp - r) / (self.range_ramp - self.range)
+            elif r > self.range_ramp:
+                kr = 0
+
+            # Influence FOV
+            t = (xb - xa).normalize() * va.normal()
+            if t > self.cosfovshell:
+                kf = 1
+            elif t > self.cosfov and t < self.cosfovshell:
+                kf = (self.cosfov - t) / (self.cosfov - self.cosfovshell)
+            elif t < self.cosfov:
+                kf = 0
+
+            # Avoidance
+            a_avoid += (self.A * (xa - xb).normalize() * (1 / (xa - xb).length()) * kr * kf)  #type: om.MFloatVector
+            # Velocity Matching
+            a_velMat += (self.V * (vb - va) * kr * kf)
+            # Centering
+            a_center += (self.C * (xb - xa) * kr * kf)
 
-            # Acceleration Prioritization
-            a_len = a_avoid.length()
-            if a_len > self.amax:
-                a_avoid = _amax * a_avoid.normal()
-                a_velMat = a_center = om.MFloatVector(0.0, 0.0, 0.0)
+        return self.prioritize(a_avoid, a_velMat, a_center)
+
+    def prioritize(self, a_avoid, a_velMat, a_center):
+        # Acceleration Prioritization
+        _amax = self.amax
+        a_len = a_avoid.length()
+        if a_len > self.amax:
+            a_avoid = _amax * a_avoid.normal()
+            a_velMat = a_center = om.MFloatVector(0.0, 0.0, 0.0)
+        else:
+            _amax = _amax - a_len
+            a_len = a_velMat.length()
+            if a_len > _amax:
+                a_velMat = _amax * a_velMat.normal()
+                a_center = om.MFloatVector(0.0, 0.0, 0.0)
             else:
                 _amax = _amax - a_len
-                a_len = a_velMat.length()
+                a_len = a_center.length()
                 if a_len > _amax:
-                    a_velMat = _amax * a_velMat.normal()
-                    a_center = om.MFloatVector(0.0, 0.0, 0.0)
-                else:
-                    _amax = _amax - a_len
-                    a_len = a_center.length()
-                    if a_len > _amax:
-                        a_center = _amax * a_center.normal()
-            aTotal = a_avoid + a_velMat + a_center
+                    a_center = _amax * a_center.normal()
+        return a_avoid + a_velMat + a_center
+
+    def flock_table(self):
+        """
+        Parameter arrays indexed by flock id. Without a flocks table the force's
+        own parameters are flock 0.
+        """
+        rows = self.flocks or [(self.A, self.V, self.C, self.amax, self.range, self.range_ramp, self.fov)]
+        t = np.array(rows, dtype=np.float32).reshape(-1, 7)
+        return {'A': t[:, 0], 'V': t[:, 1], 'C': t[:, 2], 'amax': t[:, 3], 'range': t[:, 4], 'range_ramp': t[:, 5],
+                'cosfov': np.cos(t[:, 6] * 3.14159265 / 360.0),
+                'cosfovshell': np.full(len(t), self.cosfovshell, dtype=np.float32)}
 
-            # If the boid is the lead boid
-            pq.accel[boid] = aTotal
+    def compute_array(self, pq, dt):
+        n = pq.nb_items
+        if n == 0:
+            return
+        table = self.flock_table()
+        # Boids of an unknown flock fall back to flock 0
+        flock = np.where(pq.flock < len(table['A']), pq.flock, 0)
+        leads = [pq.slot_of(i) for i in (self.leadBoid_index,) + tuple(self.leaders)]
+        leads = np.array([i for i in leads if i >= 0], dtype=np.int64)
 
+        # Boids whose acceleration is evaluated this step, the others keep their last one
+        if self.lod is not None:
+            rows = self.lod.select(pq, leads)
+        else:
+            rows = np.flatnonzero(pq.alive)
+
+        # Per-boid accelerations prioritized around the flocking terms
+        steering = {}
+        if self.obstacles:
+            steering['obstacle'] = np.zeros_like(pq.pos)
+            steering['obstacle'][rows] = self.avoid_obstacles(pq.pos[rows])
+        if self.goal_field is not None and self.goal_weight != 0.0:
+            steering['goal'] = np.zeros_like(pq.pos)
+            steering['goal'][rows] = self.goal_weight * self.goal_field.sample(pq.pos[rows])
+        if not self.brute_force:
+            # One neighbor structure for all flocks, sized for the widest range
+            self.neighbors.update(pq.pos, float(table['range_ramp'].max()), pq.alive, pq.version)
+        workers = max(1, min(self.workers, len(rows)))
+        if workers <= 1:
+            self.compute_rows(pq, rows, self.memory_budget, table, flock, steering)
+        else:
+            # Workers share pq's arrays and each writes its own rows of accel,
+            # NumPy releases the GIL inside the kernels
+            budget = self.memory_budget // workers
+            self.thread_pool(workers).map(lambda part: self.compute_rows(pq, part, budget, table, flock, steering),
+                                          np.array_split(rows, workers))
+
+        # If the boid is a leader
+        if len(leads):
+            # A single goal is steered at exactly, the grid only pays off between several
+            if self.goal_field is not None and len(self.goal_field.goals) > 1:
+                boid_dir = self.goal_field.sample(pq.pos[leads])
+            else:
+                target = np.array([self.leadBoid_goal.x, self.leadBoid_goal.y, self.leadBoid_goal.z], dtype=np.float32)
+                boid_dir = GoalFlowField.normalize(target - pq.pos[leads])
+            amax = table['amax'][flock[leads]]
+            terms = [boid_dir * amax[:, np.newaxis]]
+            if 'obstacle' in steering:
+                terms.insert(0, self.avoid_obstacles(pq.pos[leads]))
+            pq.accel[leads] = self.prioritize_array(terms, amax)
+
+    def avoid_obstacles(self, points):
+        """
+        Push out of every obstacle, ramping from zero at obstacle_range to
+        obstacle_strength on and inside the surface.
+        """
+        accel = np.zeros_like(points)
+        for obstacle in self.obstacles:
+            distance, gradient = obstacle.sample(points)
+            k = np.clip(1.0 - distance / self.obstacle_range, 0.0, 1.0) * self.obstacle_strength
+            accel += k[:, np.newaxis] * GoalFlowField.normalize(gradient)
+        return accel
+
+    def compute_rows(self, pq, rows, budget, table, flock, steering):
+        if len(rows) == 0:
+            return
+        if not self.brute_force:
+            pq.accel[rows] = self.steer_pairs(pq.pos, pq.vel, rows, budget, table, flock, steering)
+            return
+        # A block row holds about sixteen float32 temporaries per neighbor
+        block = max(1, int(budget // (pq.nb_items * 16 * 4)))
+        for begin in range(0, len(rows), block):
+            sub = rows[begin:begin + block]
+            pq.accel[sub] = self.steer_block(pq.pos, pq.vel, sub, pq.alive, table, flock, steering)
+
+    @classmethod
+    def thread_pool(cls, workers):
+        if cls._pool_size < workers:
+            cls.close_pool()
+            BoidForce._pool = ThreadPool(workers)
+            BoidForce._pool_size = workers
+        return cls._pool
+
+    @classmethod
+    def close_pool(cls):
+        if cls._pool is not None:
+            cls._pool.close()
+            cls._pool.join()
+        BoidForce._pool = None
+        BoidForce._pool_size = 0
+
+    def steer_block(self, pos, vel, rows, alive, table, flock, steering):
+        """
+        Steering accelerations of the boids in rows against every live boid,
+        evaluated as (rows, N) arrays at once.
+        """
+        xa = pos[rows]
+        va = vel[rows]
+        fa = flock[rows]
+        p = dict((key, value[fa]) for key, value in table.items())
+        d = pos[np.newaxis, :, :] - xa[:, np.newaxis, :]  # xb - xa
+        w, inv_r = self.pair_weights(d, self.unit_velocity(va)[:, np.newaxis, :],
+                                     dict((key, value[:, np.newaxis]) for key, value in p.items()))
+        w *= alive[np.newaxis, :]
+        # Matching and centering only follow the own flock
+        w_flock = w * (fa[:, np.newaxis] == flock[np.newaxis, :])
+        w_avoid = w_flock + self.cross_avoid * (w - w_flock)
+        w_sum = w_flock.sum(axis=1)[:, np.newaxis]
+
+        # Avoidance
+        a_avoid = -p['A'][:, np.newaxis] * np.einsum('bn,bnk->bk', w_avoid * inv_r * inv_r, d)
+        # Velocity Matching
+        a_velMat = p['V'][:, np.newaxis] * (np.dot(w_flock, vel) - w_sum * va)
+        # Centering
+        a_center = p['C'][:, np.newaxis] * np.einsum('bn,bnk->bk', w_flock, d)
+
+        return self.prioritize_array(self.priority_terms(a_avoid, a_velMat, a_center, steering, rows), p['amax'])
+
+    def steer_pairs(self, pos, vel, rows, budget, table, flock, steering):
+        """
+        Steering accelerations of the boids in rows (sorted) from their cached
+        neighbor pairs, processed in groups of boids whose pairs fit the memory
+        budget.
+        """
+        nl = self.neighbors
+        count = len(rows)
+        starts = nl.offsets[rows]
+        counts = nl.offsets[rows + 1] - starts
+        cum = np.concatenate(([0], np.cumsum(counts)))
+        sums = np.zeros((9, count), dtype=np.float32)
+        # A pair holds about three dozen float32 temporaries
+        chunk = max(1, int(budget // (36 * 4)))
+        begin = 0
+        while begin < count:
+            end = max(begin + 1, int(np.searchsorted(cum, cum[begin] + chunk, 'right')) - 1)
+            group = counts[begin:end]
+            total = int(group.sum())
+            local = np.repeat(np.arange(begin, end), group)
+            pairs = np.repeat(starts[begin:end] - (cum[begin + 1:end + 1] - group), group) + np.arange(cum[begin], cum[begin] + total)
+            begin = end
+            if total == 0:
+                continue
+            a = nl.rows[pairs]
+            b = nl.cols[pairs]
+            fa = flock[a]
+            p = dict((key, value[fa]) for key, value in table.items())
+            d = pos[b] - pos[a]  # xb - xa
+            w, inv_r = self.pair_weights(d, self.unit_velocity(vel[a]), p)
+            # Matching and centering only follow the own flock
+            w_flock = w * (fa == flock[b])
+            w_avoid = w_flock + self.cross_avoid * (w - w_flock)
+            terms = (
+                # Avoidance
+                -(p['A'] * w_avoid * inv_r * inv_r)[:, np.newaxis] * d,
+                # Velocity Matching
+                (p['V'] * w_flock)[:, np.newaxis] * (vel[b] - vel[a]),
+                # Centering
+                (p['C'] * w_flock)[:, np.newaxis] * d)
+            for i, term in enumerate(terms):
+                for k in range(3):
+                    sums[3 * i + k] += np.bincount(local, weights=term[:, k], minlength=count)
+        amax = table['amax'][flock[rows]]
+        terms = self.priority_terms(sums[0:3].T.copy(), sums[3:6].T.copy(), sums[6:9].T.copy(), steering, rows)
+        return self.prioritize_array(terms, amax)
+
+    @staticmethod
+    def unit_velocity(v):
+        speed = np.sqrt(np.einsum('...k,...k->...', v, v))
+        return v / np.where(speed > 0.0, speed, 1.0)[..., np.newaxis]
+
+    def pair_weights(self, d, va_n, p):
+        """
+        Combined range and FOV weight kr * kf of each pair offset d = xb - xa,
+        together with 1 / |d|. p holds the receiving boid's flock parameters.
+        """
+        r = np.sqrt(np.einsum('...k,...k->...', d, d))
+        # Coincident boids (including the boid itself) have no direction and are skipped
+        near = r > 0.0
+        inv_r = np.where(near, 1.0 / np.where(near, r, 1.0), 0.0).astype(np.float32)
+
+        # Influence Range
+        kr = np.where(r < p['range'], 1.0, np.clip((p['range_ramp'] - r) / (p['range_ramp'] - p['range']), 0.0, 1.0))
+
+        # Influence FOV
+        t = np.einsum('...k,...k->...', d, va_n) * inv_r
+        kf = np.clip((t - p['cosfov']) / (p['cosfovshell'] - p['cosfov']), 0.0, 1.0)
+
+        return (kr * kf * near).astype(np.float32), inv_r
+
+    @staticmethod
+    def priority_terms(a_avoid, a_velMat, a_center, steering, rows):
+        # Obstacle avoidance comes before the flocking terms, goal seeking after them
+        terms = [a_avoid, a_velMat, a_center]
+        if 'obstacle' in steering:
+            terms.insert(0, steering['obstacle'][rows].copy())
+        if 'goal' in steering:
+            terms.append(steering['goal'][rows].copy())
+        return terms
+
+    def prioritize_array(self, terms, amax):
+        # Acceleration Prioritization, row by row as in prioritize()
+        _amax = np.array(amax, dtype=np.float32)
+        for a in terms:
+            a_len = np.sqrt(np.einsum('bk,bk->b', a, a))
+            over = a_len > _amax
+            a[over] *= (_amax[over] / a_len[over])[:, np.newaxis]
+            _amax = np.maximum(_amax - a_len, 0.0)
+        return sum(terms)
+
+def aimRotation(v):
+    """
+    Euler rotation in degrees, XYZ order, that aims the +X axis along v.
+    """
+    length = math.sqrt(v[0] * v[0] + v[1] * v[1] + v[2] * v[2])
+    if length == 0.0:
+        return (0.0, 0.0, 0.0)
+    return (0.0, math.degrees(math.asin(-v[2] / length)), math.degrees(math.atan2(v[1], v[0])))
 
 class BoidNode(om.MPxNode):
 
@@ -150,6 +920,49 @@ class BoidNode(om.MPxNode):
     aOutput = None
     aLeadBoid_Index = None
     aGoal = None
+    aWorkers = None
+    aSkin = None
+    aNeighborRebuilds = None
+    aScheme = None
+    aSubsteps = None
+    aTimeStep = None
+    aCount = None
+    aPositions = None
+    aVelocities = None
+    aOrientations = None
+    aInstanceData = None
+    aEmitRate = None
+    aLifespan = None
+    aEmitter = None
+    aEmitRadius = None
+    aFlocks = None
+    aFlockAvoid = None
+    aFlockMatch = None
+    aFlockCenter = None
+    aFlockMaxAccel = None
+    aFlockRange = None
+    aFlockRangeRamp = None
+    aFlockFov = None
+    aFlockIds = None
+    aEmitFlock = None
+    aCrossFlockAvoid = None
+    aGoals = None
+    aLeaderIds = None
+    aGoalWeight = None
+    aFieldResolution = None
+    aFieldExtent = None
+    aLod = None
+    aLodCenter = None
+    aLodNear = None
+    aLodFar = None
+    aLodReducedRate = None
+    aLodSleepRate = None
+    aLodSleepAccel = None
+    aLodCounts = None
+    aObstacles = None
+    aObstacleRange = None
+    aObstacleStrength = None
+    aObstacleResolution = None
 
     def __init__(self):
         super(BoidNode, self).__init__()
@@ -158,43 +971,267 @@ class BoidNode(om.MPxNode):
         self._mass = 1.0
 
         self.timeStep = 0.01
-        self.state = DynamicalState()
+        if np is not None:
+            self.state = ArrayDynamicalState()
+        else:
+            self.state = DynamicalState()
         self.state.add(0)
         self.force = BoidForce(0.8, 1.0, 1.0, 5.0, 3.0, 5.0)
-        self.positionSolve = AdvancePosition(self.state)
-        self.velocitySolve = AdvancedVelocity(self.state, self.force)
+        self.integrator = BoidIntegrator(self.state, self.force)
+        self.substeps = 1
+        self._editedIndices = set()
+        self._stepTime = None
+        # Ids of the boids behind output[i] and count, in element order
+        self._baseIds = []
+        self._emitDebt = 0.0
+        self._flockIds = None
+        self.goalField = GoalFlowField() if np is not None else None
+        self.lod = BoidLOD() if np is not None else None
+        # Signed distance grids by obstacles[i] logical index, rebuilt when that mesh changes
+        self.obstacleGrids = {}
+        self._dirtyObstacles = set()
 
     def resetParameter(self):
         pass
 
+    def setDependentsDirty(self, plug, affectedPlugs):
+        # Remember which output elements the user edited so only those are read back
+        if plug.isChild:
+            plug = plug.parent()
+        if plug.isElement and plug.attribute() == BoidNode.aOutput:
+            self._editedIndices.add(plug.logicalIndex())
+        if plug.isElement and plug.attribute() == BoidNode.aObstacles:
+            self._dirtyObstacles.add(plug.logicalIndex())
+
+    def boidSlot(self, boid_id):
+        if isinstance(self.state, ArrayDynamicalState):
+            return self.state.slot_of(boid_id)
+        return boid_id
+
     def updatePos(self, plug, data):
-        if self.state.nb_items < plug.numElements():
-            self.state.add(plug.numElements() - self.state.nb_items)
-        for plugIndex in xrange(plug.numElements()):
-            aPlug = plug.elementByLogicalIndex(plugIndex)
-            for childIndex in xrange(aPlug.numChildren()):
-                self.state.pos[plugIndex][childIndex] = aPlug.child(childIndex).asFloat()
+        output_array_handle = data.outputArrayValue(BoidNode.aOutput)  #type: om.MArrayDataHandle
+        numElements = len(output_array_handle)
+        count = max(numElements, data.inputValue(self.aCount).asInt())
+        first = len(self._baseIds)
+        if first < count:
+            # Elements added since the last step start from their stored values
+            self._editedIndices.update(range(first, numElements))
+            if isinstance(self.state, ArrayDynamicalState):
+                self._baseIds.extend(self.state.emit(count - first).tolist())
+            else:
+                self.state.add(count - first)
+                self._baseIds.extend(range(first, count))
+            # Boids without an output element are scattered around the origin
+            spread = self.force.range_ramp
+            for plugIndex in xrange(max(first, numElements), count):
+                boid = self.boidSlot(self._baseIds[plugIndex])
+                for childIndex in xrange(3):
+                    self.state.pos[boid][childIndex] = random.uniform(-spread, spread)
+        for plugIndex in self._editedIndices:
+            if plugIndex >= len(self._baseIds):
+                continue
+            boid = self.boidSlot(self._baseIds[plugIndex])
+            try:
+                output_array_handle.jumpToLogicalElement(plugIndex)
+            except RuntimeError:
+                continue
+            value = output_array_handle.outputValue().asFloatVector()
+            for childIndex in xrange(3):
+                self.state.pos[boid][childIndex] = value[childIndex]
+        self._editedIndices.clear()
+
+    def updateEmission(self, data):
+        if not isinstance(self.state, ArrayDynamicalState):
+            return
+        state = self.state
+
+        # Remove the emitted boids that outlived their lifespan
+        state.age[:] += 1.0
+        state.kill(state.ids[state.alive & (state.age >= state.lifespan)].tolist())
+
+        self._emitDebt += data.inputValue(self.aEmitRate).asFloat()
+        count = int(self._emitDebt)
+        if count > 0:
+            self._emitDebt -= count
+            center = data.inputValue(self.aEmitter).asFloatVector()
+            radius = data.inputValue(self.aEmitRadius).asFloat()
+            lifespan = data.inputValue(self.aLifespan).asFloat()
+            # Uniform in the emitter sphere
+            offsets = np.random.normal(size=(count, 3))
+            offsets *= (radius * np.random.uniform(0.0, 1.0, (count, 1)) ** (1.0 / 3.0)
+                        / np.maximum(np.linalg.norm(offsets, axis=1, keepdims=True), 1e-9))
+            state.emit(count, np.array([center.x, center.y, center.z]) + offsets,
+                       lifespan=lifespan if lifespan > 0.0 else np.inf,
+                       flock=data.inputValue(self.aEmitFlock).asInt())
+
+        state.maybe_compact()
+
+    def updateFlocks(self, data):
+        if not isinstance(self.state, ArrayDynamicalState):
+            return
+        self.force.cross_avoid = data.inputValue(self.aCrossFlockAvoid).asFloat()
+
+        # Parameter table rows by logical index, missing indices keep the default flock
+        flocks_handle = data.inputArrayValue(self.aFlocks)  #type: om.MArrayDataHandle
+        rows = {}
+        for physicalIndex in xrange(len(flocks_handle)):
+            flocks_handle.jumpToPhysicalElement(physicalIndex)
+            flock_handle = flocks_handle.inputValue()
+            rows[flocks_handle.elementLogicalIndex()] = tuple(
+                flock_handle.child(attr).asFloat() for attr in (self.aFlockAvoid, self.aFlockMatch, self.aFlockCenter,
+                                                               self.aFlockMaxAccel, self.aFlockRange,
+                                                               self.aFlockRangeRamp, self.aFlockFov))
+        if rows:
+            force = self.force
+            default = (force.A, force.V, force.C, force.amax, force.range, force.range_ramp, force.fov)
+            force.flocks = [rows.get(i, default) for i in xrange(max(rows) + 1)]
+        else:
+            self.force.flocks = None
+
+        # Flock ids of output[i] / count boids, only reapplied when they change
+        flockIds = list(om.MFnIntArrayData(data.inputValue(self.aFlockIds).data()).array())
+        flockIds = flockIds[:len(self._baseIds)]
+        if flockIds != self._flockIds:
+            self._flockIds = flockIds
+            for plugIndex, flock in enumerate(flockIds):
+                boid = self.boidSlot(self._baseIds[plugIndex])
+                if boid >= 0:
+                    self.state.flock[boid] = flock
+
+    def updateGoals(self, data, goal):
+        if not isinstance(self.state, ArrayDynamicalState):
+            return
+        self.force.leaders = tuple(om.MFnIntArrayData(data.inputValue(self.aLeaderIds).data()).array())
+        self.force.goal_weight = data.inputValue(self.aGoalWeight).asFloat()
+
+        resolution = data.inputValue(self.aFieldResolution).asInt()
+        if resolution == 0:
+            # Leaders steer straight at the goal, nothing to sample for the other boids
+            self.force.goal_field = None
+            return
+        goals = [(goal.x, goal.y, goal.z)]
+        goals_handle = data.inputArrayValue(self.aGoals)  #type: om.MArrayDataHandle
+        for physicalIndex in xrange(len(goals_handle)):
+            goals_handle.jumpToPhysicalElement(physicalIndex)
+            value = goals_handle.inputValue().asFloatVector()
+            goals.append((value.x, value.y, value.z))
+        # Only resampled when a goal moved or the grid layout changed
+        self.goalField.update(goals, data.inputValue(self.aFieldExtent).asFloat(), resolution)
+        self.force.goal_field = self.goalField
+
+    def updateLOD(self, data):
+        if not isinstance(self.state, ArrayDynamicalState):
+            return
+        if not data.inputValue(self.aLod).asBool():
+            self.force.lod = None
+            return
+        center = data.inputValue(self.aLodCenter).asFloatVector()
+        self.lod.center = np.array([center.x, center.y, center.z], dtype=np.float32)
+        self.lod.near = data.inputValue(self.aLodNear).asFloat()
+        self.lod.far = data.inputValue(self.aLodFar).asFloat()
+        self.lod.reduced_rate = data.inputValue(self.aLodReducedRate).asInt()
+        self.lod.sleep_rate = data.inputValue(self.aLodSleepRate).asInt()
+        self.lod.sleep_accel = data.inputValue(self.aLodSleepAccel).asFloat()
+        self.force.lod = self.lod
+
+    def updateObstacles(self, data):
+        if not isinstance(self.state, ArrayDynamicalState):
+            return
+        self.force.obstacle_range = data.inputValue(self.aObstacleRange).asFloat()
+        self.force.obstacle_strength = data.inputValue(self.aObstacleStrength).asFloat()
+        # The grid covers the mesh bounds padded by the range the boids react within
+        key = (self.force.obstacle_range, data.inputValue(self.aObstacleResolution).asInt())
+
+        grids = {}
+        obstacles_handle = data.inputArrayValue(self.aObstacles)  #type: om.MArrayDataHandle
+        for physicalIndex in xrange(len(obstacles_handle)):
+            obstacles_handle.jumpToPhysicalElement(physicalIndex)
+            index = obstacles_handle.elementLogicalIndex()
+            mesh = obstacles_handle.inputValue().asMesh()
+            if mesh.isNull():
+                continue
+            grid = self.obstacleGrids.get(index)
+            if grid is None or grid.key != key or index in self._dirtyObstacles:
+                grid = SignedDistanceGrid()
+                grid.build(mesh, key[0], key[1])
+                grid.key = key
+            grids[index] = grid
+        self._dirtyObstacles.clear()
+        self.obstacleGrids = grids
+        self.force.obstacles = [grids[index] for index in sorted(grids)]
+
+    def stateRows(self, data, live=True):
+        if isinstance(self.state, ArrayDynamicalState):
+            if live:
+                data = data[self.state.alive]
+            return data.tolist()
+        return [(v.x, v.y, v.z) for v in data]
+
+    def liveIds(self):
+        if isinstance(self.state, ArrayDynamicalState):
+            return self.state.ids[self.state.alive].tolist()
+        return list(range(self.state.nb_items))
 
     def updateOutput(self, plug, data):
-        if self.state.nb_items < plug.numElements():
-            self.state.add(plug.numElements() - self.state.nb_items)
-        for plugIndex in xrange(plug.numElements()):
-            aPlug = plug.elementByLogicalIndex(plugIndex)
-            for childIndex in xrange(aPlug.numChildren()):
-                aPlug.child(childIndex).setFloat(self.state.pos[plugIndex][childIndex])
+        if plug == BoidNode.aOutput:
+            output_array_handle = data.outputArrayValue(BoidNode.aOutput)  #type: om.MArrayDataHandle
+            numElements = min(len(output_array_handle), len(self._baseIds))
+            builder = om.MArrayDataBuilder(data, BoidNode.aOutput, numElements)
+            positions = self.stateRows(self.state.pos, live=False)
+            for plugIndex in xrange(numElements):
+                p = positions[self.boidSlot(self._baseIds[plugIndex])]
+                builder.addElement(plugIndex).set3Float(p[0], p[1], p[2])
+            output_array_handle.set(builder)
+            output_array_handle.setAllClean()
+            return
+
+        if plug == BoidNode.aInstanceData:
+            # One arrayAttrs bundle for an instancer's inputPoints
+            array_attrs_fn = om.MFnArrayAttrsData()
+            array_attrs = array_attrs_fn.create()
+            positions = array_attrs_fn.vectorArray("position")
+            velocities = array_attrs_fn.vectorArray("velocity")
+            rotations = array_attrs_fn.vectorArray("rotation")
+            ids = array_attrs_fn.doubleArray("id")
+            for boid_id, p, v in zip(self.liveIds(), self.stateRows(self.state.pos), self.stateRows(self.state.vel)):
+                positions.append(om.MVector(*p))
+                velocities.append(om.MVector(*v))
+                rotations.append(om.MVector(*aimRotation(v)))
+                ids.append(boid_id)
+            data.outputValue(BoidNode.aInstanceData).setMObject(array_attrs)
+            data.setClean(plug)
+            return
+
+        if plug == BoidNode.aPositions:
+            values = self.stateRows(self.state.pos)
+        elif plug == BoidNode.aVelocities:
+            values = self.stateRows(self.state.vel)
+        else:
+            values = [aimRotation(v) for v in self.stateRows(self.state.vel)]
+        vector_array = om.MVectorArray([om.MVector(*v) for v in values])
+        data.outputValue(plug).setMObject(om.MFnVectorArrayData().create(vector_array))
+        data.setClean(plug)
 
     def solve(self, dt):
-        self.positionSolve.solve(dt)
-        self.velocitySolve.solve(dt)
+        self.integrator.solve(dt, self.substeps)
 
     def compute(self, plug, data):
-        if plug != BoidNode.aOutput or plug.isArray == False:
+        if plug == BoidNode.aOutput:
+            if plug.isArray == False:
+                return
+        elif plug not in (BoidNode.aPositions, BoidNode.aVelocities, BoidNode.aOrientations, BoidNode.aInstanceData,
+                          BoidNode.aNeighborRebuilds, BoidNode.aLodCounts):
             return
 
         # Get the inputs
         currentTime = data.inputValue(self.aTime).asTime()
         goal = data.inputValue(self.aGoal).asFloatVector()
         leadBoid = data.inputValue(self.aLeadBoid_Index).asInt()
+        self.force.workers = data.inputValue(self.aWorkers).asInt()
+        self.force.neighbors.skin = data.inputValue(self.aSkin).asFloat()
+        self.integrator.scheme = BoidIntegrator.SCHEMES[data.inputValue(self.aScheme).asShort()]
+        self.substeps = data.inputValue(self.aSubsteps).asInt()
+        self.timeStep = data.inputValue(self.aTimeStep).asFloat()
         self.force.leadBoid_index = leadBoid
         self.force.leadBoid_goal = goal
 
@@ -207,15 +1244,34 @@ class BoidNode(om.MPxNode):
         if timeDifference > 1.0 or timeDifference < 0.0:
             self._initialized = False
             self._previousTime = currentTime
+            self._stepTime = None
             data.setClean(plug)
             return
         self._previousTime = om.MTime(currentTime)
 
-        self.updatePos(plug, data)
+        # Every output pulled at the same time shares one step
+        if self._stepTime != currentTime.value:
+            self._stepTime = currentTime.value
+            self.updatePos(plug, data)
+            self.updateEmission(data)
+            self.updateFlocks(data)
+            self.updateGoals(data, goal)
+            self.updateLOD(data)
+            self.updateObstacles(data)
+            self.solve(self.timeStep)
+
+        # The counters are written below for every plug
+        if plug != BoidNode.aNeighborRebuilds and plug != BoidNode.aLodCounts:
+            self.updateOutput(plug, data)
 
-        self.solve(self.timeStep)
+        rebuilds_data_handle = data.outputValue(BoidNode.aNeighborRebuilds)  #type: om.MDataHandle
+        rebuilds_data_handle.setInt(self.force.neighbors.rebuilds)
+        rebuilds_data_handle.setClean()
 
-        self.updateOutput(plug, data)
+        lod_counts = list(self.force.lod.counts) if self.force.lod is not None else []
+        lod_counts_handle = data.outputValue(BoidNode.aLodCounts)  #type: om.MDataHandle
+        lod_counts_handle.setMObject(om.MFnIntArrayData().create(om.MIntArray(lod_counts)))
+        lod_counts_handle.setClean()
 
         output_data_handle = data.outputValue(BoidNode.aPos)  #type: om.MDataHandle
         output_data_handle.setClean()
@@ -229,6 +1285,9 @@ class BoidNode(om.MPxNode):
     def initialize(cls):
         numeric_attr = om.MFnNumericAttribute()
         unit_attr = om.MFnUnitAttribute()
+        enum_attr = om.MFnEnumAttribute()
+        typed_attr = om.MFnTypedAttribute()
+        compound_attr = om.MFnCompoundAttribute()
 
         cls.aTime = unit_attr.create('time', 'time', om.MFnUnitAttribute.kTime, 0.0)
         unit_attr.keyable = True
@@ -248,13 +1307,185 @@ class BoidNode(om.MPxNode):
         cls.aGoal = numeric_attr.createPoint('goal', 'goal')
         numeric_attr.keyable = True
 
+        cls.aWorkers = numeric_attr.create("workers", "workers", om.MFnNumericData.kInt, 1)
+        numeric_attr.setMin(1)
+
+        cls.aSkin = numeric_attr.create("skin", "skin", om.MFnNumericData.kFloat, 0.5)
+        numeric_attr.setMin(0.0)
+
+        cls.aNeighborRebuilds = numeric_attr.create("neighborRebuilds", "nbr", om.MFnNumericData.kInt, 0)
+        numeric_attr.writable = False
+        numeric_attr.storable = False
+
+        cls.aScheme = enum_attr.create("scheme", "scheme", 0)
+        enum_attr.addField("Symplectic Euler", 0)
+        enum_attr.addField("Velocity Verlet", 1)
+        enum_attr.addField("RK2", 2)
+
+        cls.aSubsteps = numeric_attr.create("substeps", "substeps", om.MFnNumericData.kInt, 1)
+        numeric_attr.setMin(1)
+
+        cls.aTimeStep = numeric_attr.create("timeStep", "dt", om.MFnNumericData.kFloat, 0.01)
+        numeric_attr.setMin(0.0)
+
+        cls.aCount = numeric_attr.create("count", "count", om.MFnNumericData.kInt, 0)
+        numeric_attr.setMin(0)
+
+        cls.aPositions = typed_attr.create("positions", "positions", om.MFnData.kVectorArray, om.MFnVectorArrayData().create())
+        typed_attr.writable = False
+        typed_attr.storable = False
+
+        cls.aVelocities = typed_attr.create("velocities", "velocities", om.MFnData.kVectorArray, om.MFnVectorArrayData().create())
+        typed_attr.writable = False
+        typed_attr.storable = False
+
+        cls.aOrientations = typed_attr.create("orientations", "orientations", om.MFnData.kVectorArray, om.MFnVectorArrayData().create())
+        typed_attr.writable = False
+        typed_attr.storable = False
+
+        cls.aInstanceData = typed_attr.create("instanceData", "instanceData", om.MFnData.kDynArrayAttrs)
+        typed_attr.writable = False
+        typed_attr.storable = False
+
+        cls.aEmitRate = numeric_attr.create("emitRate", "emitRate", om.MFnNumericData.kFloat, 0.0)
+        numeric_attr.setMin(0.0)
+        numeric_attr.keyable = True
+
+        cls.aLifespan = numeric_attr.create("lifespan", "lifespan", om.MFnNumericData.kFloat, 0.0)
+        numeric_attr.setMin(0.0)
+        numeric_attr.keyable = True
+
+        cls.aEmitter = numeric_attr.createPoint("emitter", "emitter")
+        numeric_attr.keyable = True
+
+        cls.aEmitRadius = numeric_attr.create("emitRadius", "emitRadius", om.MFnNumericData.kFloat, 1.0)
+        numeric_attr.setMin(0.0)
+
+        cls.aFlockAvoid = numeric_attr.create("avoid", "avoid", om.MFnNumericData.kFloat, 0.8)
+        cls.aFlockMatch = numeric_attr.create("match", "match", om.MFnNumericData.kFloat, 1.0)
+        cls.aFlockCenter = numeric_attr.create("center", "center", om.MFnNumericData.kFloat, 1.0)
+        cls.aFlockMaxAccel = numeric_attr.create("maxAccel", "maxAccel", om.MFnNumericData.kFloat, 5.0)
+        cls.aFlockRange = numeric_attr.create("range", "range", om.MFnNumericData.kFloat, 3.0)
+        cls.aFlockRangeRamp = numeric_attr.create("rangeRamp", "rangeRamp", om.MFnNumericData.kFloat, 5.0)
+        cls.aFlockFov = numeric_attr.create("fov", "fov", om.MFnNumericData.kFloat, 152.0)
+
+        cls.aFlocks = compound_attr.create("flocks", "flocks")
+        for child in (cls.aFlockAvoid, cls.aFlockMatch, cls.aFlockCenter, cls.aFlockMaxAccel,
+                      cls.aFlockRange, cls.aFlockRangeRamp, cls.aFlockFov):
+            compound_attr.addChild(child)
+        compound_attr.array = True
+
+        cls.aFlockIds = typed_attr.create("flockIds", "flockIds", om.MFnData.kIntArray, om.MFnIntArrayData().create())
+
+        cls.aEmitFlock = numeric_attr.create("emitFlock", "emitFlock", om.MFnNumericData.kInt, 0)
+        numeric_attr.setMin(0)
+
+        cls.aCrossFlockAvoid = numeric_attr.create("crossFlockAvoid", "crossFlockAvoid", om.MFnNumericData.kFloat, 0.0)
+        numeric_attr.setMin(0.0)
+
+        cls.aGoals = numeric_attr.createPoint("goals", "goals")
+        numeric_attr.array = True
+        numeric_attr.keyable = True
+
+        cls.aLeaderIds = typed_attr.create("leaderIds", "leaderIds", om.MFnData.kIntArray, om.MFnIntArrayData().create())
+
+        cls.aGoalWeight = numeric_attr.create("goalWeight", "goalWeight", om.MFnNumericData.kFloat, 0.0)
+        numeric_attr.keyable = True
+
+        # Samples per axis of the goal flow field, 0 steers straight at the goal
+        cls.aFieldResolution = numeric_attr.create("fieldResolution", "fieldResolution", om.MFnNumericData.kInt, 0)
+        numeric_attr.setMin(0)
+
+        cls.aFieldExtent = numeric_attr.create("fieldExtent", "fieldExtent", om.MFnNumericData.kFloat, 20.0)
+        numeric_attr.setMin(0.0)
+
+        cls.aLod = numeric_attr.create("lod", "lod", om.MFnNumericData.kBoolean, False)
+
+        cls.aLodCenter = numeric_attr.createPoint("lodCenter", "lodCenter")
+
+        cls.aLodNear = numeric_attr.create("lodNear", "lodNear", om.MFnNumericData.kFloat, 20.0)
+        numeric_attr.setMin(0.0)
+
+        cls.aLodFar = numeric_attr.create("lodFar", "lodFar", om.MFnNumericData.kFloat, 60.0)
+        numeric_attr.setMin(0.0)
+
+        cls.aLodReducedRate = numeric_attr.create("lodReducedRate", "lodReducedRate", om.MFnNumericData.kInt, 2)
+        numeric_attr.setMin(1)
+
+        cls.aLodSleepRate = numeric_attr.create("lodSleepRate", "lodSleepRate", om.MFnNumericData.kInt, 8)
+        numeric_attr.setMin(1)
+
+        cls.aLodSleepAccel = numeric_attr.create("lodSleepAccel", "lodSleepAccel", om.MFnNumericData.kFloat, 0.001)
+        numeric_attr.setMin(0.0)
+
+        # Live boids in the full, reduced and sleeping tiers
+        cls.aLodCounts = typed_attr.create("lodCounts", "lodCounts", om.MFnData.kIntArray, om.MFnIntArrayData().create())
+        typed_attr.writable = False
+        typed_attr.storable = False
+
+        cls.aObstacles = typed_attr.create("obstacles", "obstacles", om.MFnData.kMesh)
+        typed_attr.array = True
+        typed_attr.storable = False
+
+        cls.aObstacleRange = numeric_attr.create("obstacleRange", "obstacleRange", om.MFnNumericData.kFloat, 2.0)
+        numeric_attr.setMin(0.001)
+
+        cls.aObstacleStrength = numeric_attr.create("obstacleStrength", "obstacleStrength", om.MFnNumericData.kFloat, 10.0)
+        numeric_attr.setMin(0.0)
+        numeric_attr.keyable = True
+
+        cls.aObstacleResolution = numeric_attr.create("obstacleResolution", "obstacleResolution", om.MFnNumericData.kInt, 24)
+        numeric_attr.setMin(2)
+
         cls.addAttribute(cls.aPos)
         cls.addAttribute(cls.aTime)
         cls.addAttribute(cls.aOutput)
         cls.addAttribute(cls.aLeadBoid_Index)
         cls.addAttribute(cls.aGoal)
+        cls.addAttribute(cls.aWorkers)
+        cls.addAttribute(cls.aSkin)
+        cls.addAttribute(cls.aNeighborRebuilds)
+        cls.addAttribute(cls.aScheme)
+        cls.addAttribute(cls.aSubsteps)
+        cls.addAttribute(cls.aTimeStep)
+        cls.addAttribute(cls.aCount)
+        cls.addAttribute(cls.aPositions)
+        cls.addAttribute(cls.aVelocities)
+        cls.addAttribute(cls.aOrientations)
+        cls.addAttribute(cls.aInstanceData)
+        cls.addAttribute(cls.aEmitRate)
+        cls.addAttribute(cls.aLifespan)
+        cls.addAttribute(cls.aEmitter)
+        cls.addAttribute(cls.aEmitRadius)
+        cls.addAttribute(cls.aFlocks)
+        cls.addAttribute(cls.aFlockIds)
+        cls.addAttribute(cls.aEmitFlock)
+        cls.addAttribute(cls.aCrossFlockAvoid)
+        cls.addAttribute(cls.aGoals)
+        cls.addAttribute(cls.aLeaderIds)
+        cls.addAttribute(cls.aGoalWeight)
+        cls.addAttribute(cls.aFieldResolution)
+        cls.addAttribute(cls.aFieldExtent)
+        cls.addAttribute(cls.aLod)
+        cls.addAttribute(cls.aLodCenter)
+        cls.addAttribute(cls.aLodNear)
+        cls.addAttribute(cls.aLodFar)
+        cls.addAttribute(cls.aLodReducedRate)
+        cls.addAttribute(cls.aLodSleepRate)
+        cls.addAttribute(cls.aLodSleepAccel)
+        cls.addAttribute(cls.aLodCounts)
+        cls.addAttribute(cls.aObstacles)
+        cls.addAttribute(cls.aObstacleRange)
+        cls.addAttribute(cls.aObstacleStrength)
+        cls.addAttribute(cls.aObstacleResolution)
 
         cls.attributeAffects(cls.aTime, cls.aOutput)
+        cls.attributeAffects(cls.aTime, cls.aPositions)
+        cls.attributeAffects(cls.aTime, cls.aVelocities)
+        cls.attributeAffects(cls.aTime, cls.aOrientations)
+        cls.attributeAffects(cls.aTime, cls.aInstanceData)
+        cls.attributeAffects(cls.aTime, cls.aNeighborRebuilds)
+        cls.attributeAffects(cls.aTime, cls.aLodCounts)
 
 def initializePlugin(plugin):
     vecdor = "Xicheng"
@@ -271,6 +1502,7 @@ def initializePlugin(plugin):
         om.MGlobal.displayError("Failed to register node: {0}".format(BoidNode.TYPE_NAME))
 
 def uninitializePlugin(plugin):
+    BoidForce.close_pool()
     fnPlugin = om.MFnPlugin(plugin)
     try:
         fnPlugin.deregisterNode(BoidNode.TYPE_ID)
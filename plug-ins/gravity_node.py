@@ -2,6 +2,12 @@ import maya.api.OpenMaya as om
 import maya.cmds as cmds
 import math
 import random
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 def maya_useNewAPI():
     """
@@ -12,32 +18,332 @@ def maya_useNewAPI():
 
 class CollisionSurfaceRaw:
     tri_elements = None
+    bvh = None
+    arrays = None
+    # Up to this many triangles hit_many() tests every particle against every triangle,
+    # beyond it only against the triangles the hierarchy finds along each swept segment
+    dense_triangles = 64
+    # Particles per hierarchy traversal, bounding its temporaries
+    query_block = 4096
 
     def __init__(self, t):
+        # Either a list of CollisionTriangleRaw or a CollisionTriangleArrays table
         self.tri_elements = t
+        if isinstance(t, list):
+            self.bvh = CollisionBVH(*CollisionBVH.triangle_bounds(t))
+        else:
+            self.arrays = t
+            self.bvh = CollisionBVH(*t.bounds())
+
+    def move_points(self, points, triangles):
+        # Same topology, moved vertices: update the triangles and refit the hierarchy in place
+        if self.tri_elements is self.arrays:
+            self.arrays.set_points(points)
+        else:
+            for tri, (i0, i1, i2) in zip(self.tri_elements, triangles):
+                tri.set_points(om.MVector(*points[i0]), om.MVector(*points[i1]), om.MVector(*points[i2]))
+        self.refit()
+
+    def refit(self):
+        if self.tri_elements is self.arrays:
+            self.bvh.refit(*self.arrays.bounds())
+        else:
+            self.bvh.refit(*CollisionBVH.triangle_bounds(self.tri_elements))
+            self.arrays = None
+
+    def hit_many(self, P, V, tmax):
+        """
+        Batched hit() for arrays of positions and velocities shaped (n, 3),
+        with tmax shared or given per particle. Returns the largest backwards
+        t per particle, tmax where nothing was hit, the index of the
+        triangle hit, -1 for none, and its normal, zero for none.
+        """
+        if self.arrays is None:
+            self.arrays = CollisionTriangleArrays.from_triangles(self.tri_elements)
+        if len(self.arrays) <= self.dense_triangles:
+            t, tri = self.arrays.hit(P, V, tmax)
+        else:
+            t, tri = self.hit_hierarchy(P, V, tmax)
+        normal = np.zeros((len(t), 3))
+        normal[tri >= 0] = self.arrays.normal[tri[tri >= 0]]
+        return t, tri, normal
+
+    def hit_hierarchy(self, P, V, tmax):
+        # The batched test on the (particle, triangle) pairs the hierarchy yields
+        P = np.asarray(P, dtype=np.float64).reshape(-1, 3)
+        V = np.asarray(V, dtype=np.float64).reshape(-1, 3)
+        tmax = np.broadcast_to(np.asarray(tmax, dtype=np.float64), (len(P),))
+        t_hit = tmax.copy()
+        best = np.full(len(P), -1, dtype=np.int64)
+        for start in range(0, len(P), self.query_block):
+            end = start + self.query_block
+            block_P = P[start:end]
+            block_V = V[start:end]
+            block_tmax = tmax[start:end]
+            particle, index = self.bvh.query(block_P, block_V * -block_tmax[:, np.newaxis])
+            t = self.arrays.hit_pairs(block_P[particle], block_V[particle], block_tmax[particle], index)
+            hit = t > -np.inf
+            particle, index, t = particle[hit], index[hit], t[hit]
+            # Largest backwards t per particle, ties go to the first triangle like hit()
+            order = np.lexsort((index, -t, particle))
+            particle, index, t = particle[order], index[order], t[order]
+            first = np.ones(len(particle), dtype=bool)
+            first[1:] = particle[1:] != particle[:-1]
+            t_hit[start + particle[first]] = t[first]
+            best[start + particle[first]] = index[first]
+        return t_hit, best
 
     def hit(self, P, V, CollData):
         tmax = CollData['t']
         tc = []
         tc.append(CollData['t'])
         CollData['status'] = False
-        isFirst = True
+        best = -1
+        table = self.arrays if self.tri_elements is self.arrays else None
 
-        # Find all triangles that intersect
-        for tri in self.tri_elements:
-            if tri.hit(P, V, tmax, tc):
-                # Find the largest backwards T (tc)
-                if isFirst:
-                    CollData['t'] = tc[0]
-                    CollData['tri'] = tri
-                    CollData['status'] = True
-                    isFirst = False
-                elif tc[0] > CollData['t']:
+        # Find all triangles that intersect, only in the subtrees the swept segment reaches
+        for index in self.bvh.candidates(P, V * -tmax, tmax, CollData):
+            if table is not None:
+                result = table.hit_one(index, P, V, tmax, tc)
+            else:
+                result = self.tri_elements[index].hit(P, V, tmax, tc)
+            if result:
+                # Find the largest backwards T (tc), ties go to the first triangle like a linear scan
+                if best < 0 or tc[0] > CollData['t'] or (tc[0] == CollData['t'] and index < best):
                     CollData['t'] = tc[0]
-                    CollData['tri'] = tri
                     CollData['status'] = True
+                    best = index
+        if best >= 0:
+            CollData['tri'] = self.tri_elements[best]
+            CollData['normal'] = CollData['tri'].normal
         return CollData['status']
 
+class CollisionBVH:
+    """
+    Bounding volume hierarchy over per-triangle bounds, given as lower and
+    upper corners (lists of [x, y, z] or (T, 3) arrays). Nodes are stored flat
+    in typed arrays, parents before children, so bounds can be refit bottom-up
+    in place.
+    """
+    LEAF_SIZE = 4
+
+    def __init__(self, tri_lo, tri_hi):
+        self.lo = array('d')
+        self.hi = array('d')
+        # Left and right child per node, -1 for leaves
+        self.children = array('l')
+        # Range of order covered by each node
+        self.span = array('l')
+        # Nodes grouped by depth for the NumPy refit, and the node tables as arrays
+        # for query(), built on their first use
+        self.levels = None
+        self.tables = None
+        if isinstance(tri_lo, list):
+            self.order = list(range(len(tri_lo)))
+        else:
+            self.order = np.arange(len(tri_lo))
+        if len(tri_lo):
+            self.build(0, len(tri_lo), tri_lo, tri_hi)
+
+    @staticmethod
+    def triangle_bounds(triangles):
+        tri_lo = []
+        tri_hi = []
+        for tri in triangles:
+            points = [(p.x, p.y, p.z) for p in (tri.P0, tri.P1, tri.P2)]
+            lo = [min(p[k] for p in points) for k in range(3)]
+            hi = [max(p[k] for p in points) for k in range(3)]
+            # Pad so a hit point rounded onto an edge stays inside its box
+            pad = 1e-6 * max(max(hi[k] - lo[k] for k in range(3)), 1.0)
+            tri_lo.append([v - pad for v in lo])
+            tri_hi.append([v + pad for v in hi])
+        return tri_lo, tri_hi
+
+    def build(self, start, end, tri_lo, tri_hi):
+        node = len(self.span) // 2
+        self.span.extend((start, end))
+        self.children.extend((-1, -1))
+        self.lo.extend((0.0, 0.0, 0.0))
+        self.hi.extend((0.0, 0.0, 0.0))
+        if end - start > self.LEAF_SIZE:
+            self.split(start, end, tri_lo, tri_hi)
+            mid = (start + end) // 2
+            left = self.build(start, mid, tri_lo, tri_hi)
+            right = self.build(mid, end, tri_lo, tri_hi)
+            self.children[2 * node] = left
+            self.children[2 * node + 1] = right
+        self.fit(node, tri_lo, tri_hi)
+        return node
+
+    def split(self, start, end, tri_lo, tri_hi):
+        # Median split along the longest axis of the triangle centers
+        indices = self.order[start:end]
+        if isinstance(indices, list):
+            centers = [[tri_lo[i][k] + tri_hi[i][k] for k in range(3)] for i in indices]
+            extent = [max(c[k] for c in centers) - min(c[k] for c in centers) for k in range(3)]
+            axis = extent.index(max(extent))
+            self.order[start:end] = [i for c, i in sorted(zip([c[axis] for c in centers], indices))]
+        else:
+            centers = tri_lo[indices] + tri_hi[indices]
+            axis = int(np.argmax(centers.max(axis=0) - centers.min(axis=0)))
+            self.order[start:end] = indices[np.argsort(centers[:, axis], kind='mergesort')]
+
+    def fit(self, node, tri_lo, tri_hi):
+        left = self.children[2 * node]
+        right = self.children[2 * node + 1]
+        if left >= 0:
+            lo = [min(self.lo[3 * left + k], self.lo[3 * right + k]) for k in range(3)]
+            hi = [max(self.hi[3 * left + k], self.hi[3 * right + k]) for k in range(3)]
+        else:
+            indices = self.order[self.span[2 * node]:self.span[2 * node + 1]]
+            if isinstance(indices, list):
+                lo = [min(tri_lo[i][k] for i in indices) for k in range(3)]
+                hi = [max(tri_hi[i][k] for i in indices) for k in range(3)]
+            else:
+                lo = tri_lo[indices].min(axis=0).tolist()
+                hi = tri_hi[indices].max(axis=0).tolist()
+        self.lo[3 * node:3 * node + 3] = array('d', lo)
+        self.hi[3 * node:3 * node + 3] = array('d', hi)
+
+    def refit(self, tri_lo, tri_hi):
+        # Same topology, moved vertices: update the boxes without re-sorting
+        if isinstance(self.order, list):
+            for node in reversed(range(len(self.span) // 2)):
+                self.fit(node, tri_lo, tri_hi)
+            return
+        if not self.span:
+            return
+        if self.levels is None:
+            self.levels = self.node_levels()
+        leaves, starts, inner = self.levels
+        # Views onto the typed arrays, so the boxes are written in place
+        lo = np.frombuffer(self.lo).reshape(-1, 3)
+        hi = np.frombuffer(self.hi).reshape(-1, 3)
+        # Leaves cover order in disjoint ranges, one reduceat per corner fits them all
+        lo[leaves] = np.minimum.reduceat(tri_lo[self.order], starts)
+        hi[leaves] = np.maximum.reduceat(tri_hi[self.order], starts)
+        # Then each level of inner nodes from their children, deepest first
+        for nodes, left, right in inner:
+            lo[nodes] = np.minimum(lo[left], lo[right])
+            hi[nodes] = np.maximum(hi[left], hi[right])
+
+    def node_levels(self):
+        """
+        Leaves sorted by the start of their range, with those starts, and
+        (nodes, left, right) index arrays of the inner nodes one level at a
+        time from the deepest up.
+        """
+        children = np.array(self.children, dtype=np.int64).reshape(-1, 2)
+        span = np.array(self.span, dtype=np.int64).reshape(-1, 2)
+        depth = np.zeros(len(children), dtype=np.int64)
+        # Parents are stored before their children
+        for node in range(len(children)):
+            if children[node, 0] >= 0:
+                depth[children[node]] = depth[node] + 1
+        leaves = np.flatnonzero(children[:, 0] < 0)
+        leaves = leaves[np.argsort(span[leaves, 0])]
+        inner = []
+        for level in range(int(depth.max()), -1, -1):
+            nodes = np.flatnonzero((depth == level) & (children[:, 0] >= 0))
+            if len(nodes):
+                inner.append((nodes, children[nodes, 0], children[nodes, 1]))
+        return leaves, span[leaves, 0], inner
+
+    def query(self, P, D):
+        """
+        Batched candidates() without the pruning: (particle, triangle) index
+        pairs of the triangles whose box the segment from P[i] to P[i] + D[i]
+        crosses. All segments go down the tree together, one level per pass.
+        """
+        particle = np.arange(len(P)) if self.span else np.zeros(0, dtype=np.int64)
+        if self.tables is None:
+            self.tables = (np.array(self.children, dtype=np.int64).reshape(-1, 2),
+                           np.array(self.span, dtype=np.int64).reshape(-1, 2),
+                           np.asarray(self.order, dtype=np.int64))
+        children, span, order = self.tables
+        lo = np.frombuffer(self.lo).reshape(-1, 3)
+        hi = np.frombuffer(self.hi).reshape(-1, 3)
+        node = np.zeros(len(particle), dtype=np.int64)
+        leaf_particles = [particle[:0]]
+        leaf_nodes = [node[:0]]
+        while len(particle):
+            crossed = self.segments_cross(lo[node], hi[node], P[particle], D[particle])
+            particle = particle[crossed]
+            node = node[crossed]
+            leaf = children[node, 0] < 0
+            leaf_particles.append(particle[leaf])
+            leaf_nodes.append(node[leaf])
+            particle = np.repeat(particle[~leaf], 2)
+            node = children[node[~leaf]].ravel()
+
+        # Every triangle of the leaves reached
+        particle = np.concatenate(leaf_particles)
+        node = np.concatenate(leaf_nodes)
+        first = span[node, 0]
+        count = span[node, 1] - first
+        ends = np.cumsum(count)
+        offset = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - count, count)
+        return np.repeat(particle, count), order[np.repeat(first, count) + offset]
+
+    @staticmethod
+    def segments_cross(lo, hi, P, D):
+        # segment_exit() as a mask over rows of boxes and segments
+        with np.errstate(divide='ignore', invalid='ignore'):
+            a = (lo - P) / D
+            b = (hi - P) / D
+        inside = (P >= lo) & (P <= hi)
+        # A segment parallel to a slab is inside it everywhere or nowhere
+        near = np.where(D == 0.0, np.where(inside, -np.inf, np.inf), np.minimum(a, b))
+        far = np.where(D == 0.0, np.where(inside, np.inf, -np.inf), np.maximum(a, b))
+        return np.maximum(near.max(axis=1), 0.0) <= np.minimum(far.min(axis=1), 1.0)
+
+    def segment_exit(self, node, P, D):
+        """
+        Slab test of the segment P + s * D, 0 <= s <= 1, against a node box.
+        Returns the exit parameter, or None if the segment misses the box.
+        """
+        s0 = 0.0
+        s1 = 1.0
+        for k, p, d in ((0, P.x, D.x), (1, P.y, D.y), (2, P.z, D.z)):
+            lo = self.lo[3 * node + k]
+            hi = self.hi[3 * node + k]
+            if d == 0.0:
+                if p < lo or p > hi:
+                    return None
+                continue
+            a = (lo - p) / d
+            b = (hi - p) / d
+            if a > b:
+                a, b = b, a
+            s0 = max(s0, a)
+            s1 = min(s1, b)
+            if s0 > s1:
+                return None
+        return s1
+
+    def candidates(self, P, D, tmax, CollData):
+        """
+        Yield the indices of triangles whose box the swept segment from P to
+        P + D crosses. Subtrees the segment leaves before the best hit found
+        so far in CollData are skipped, they can only hold earlier times.
+        """
+        if not self.span:
+            return
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            s = self.segment_exit(node, P, D)
+            if s is None:
+                continue
+            if CollData['status'] and s * tmax < CollData['t']:
+                continue
+            if self.children[2 * node] < 0:
+                for i in self.order[self.span[2 * node]:self.span[2 * node + 1]]:
+                    yield int(i)
+            else:
+                stack.append(self.children[2 * node])
+                stack.append(self.children[2 * node + 1])
+
 class CollisionTriangleRaw:
 
     P0 = None
@@ -48,6 +354,9 @@ class CollisionTriangleRaw:
     normal = None
 
     def __init__(self, _p0, _p1, _p2):
+        self.set_points(_p0, _p1, _p2)
+
+    def set_points(self, _p0, _p1, _p2):
         self.P0 = _p0
         self.P1 = _p1
         self.P2 = _p2
@@ -78,13 +387,494 @@ class CollisionTriangleRaw:
         return result
 
     def is_in_triangle(self, X):
-        u = ((self.e2 ^ self.e2) * (self.e2 ^ (X - self.P0))) / (math.pow((self.e2 ^ self.e1).length(), 2))
+        u = ((self.e2 ^ self.e1) * (self.e2 ^ (X - self.P0))) / (math.pow((self.e2 ^ self.e1).length(), 2))
         v = ((self.e1 ^ self.e2) * (self.e1 ^ (X - self.P0))) / (math.pow((self.e1 ^ self.e2).length(), 2))
 
         if (0 <= u) and (u <= 1) and ((0 <= v) and (v <= 1)) and ((0 <= (v + u)) and ((v + u) <= 1)):
             return True
         return False
 
+class CollisionTriangleArrays(object):
+    """
+    Collision triangles as contiguous float32 tables, built once per collider:
+    edges, unit normals, plane offsets, the vertex-0 edge projections and the
+    barycentric terms divided by their denominator. Both the single-particle
+    hit_one() and the batched hit() only read the tables; hit() works through
+    the particles in blocks so its (particles, triangles) temporaries stay
+    within memory_budget bytes.
+    """
+    memory_budget = 64 * 1024 * 1024
+    # Barycentric slack for float32 rounding, so a hit on a shared edge is not missed by both triangles
+    edge_epsilon = 1e-5
+
+    def __init__(self, points, triangles):
+        self.triangles = np.asarray(triangles, dtype=np.int32).reshape(-1, 3)
+        self.set_points(points)
+
+    @classmethod
+    def from_triangles(cls, triangles):
+        points = [(p.x, p.y, p.z) for tri in triangles for p in (tri.P0, tri.P1, tri.P2)]
+        return cls(points, np.arange(len(points)).reshape(-1, 3))
+
+    def set_points(self, points):
+        self.points = np.asarray(points, dtype=np.float32).reshape(-1, 3)
+        p0, p1, p2 = [self.points[self.triangles[:, k]].astype(np.float64) for k in range(3)]
+        e1 = p1 - p0
+        e2 = p2 - p0
+        normal = np.cross(e1, e2)
+        length = np.sqrt(np.einsum('tk,tk->t', normal, normal))
+        normal /= np.where(length > 0.0, length, 1.0)[:, np.newaxis]
+        d11 = np.einsum('tk,tk->t', e1, e1)
+        d22 = np.einsum('tk,tk->t', e2, e2)
+        d12 = np.einsum('tk,tk->t', e1, e2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Degenerate triangles get non-finite terms and never pass the inside test
+            inv_den = 1.0 / (d11 * d22 - d12 * d12)
+            self.b11 = (d11 * inv_den).astype(np.float32)
+            self.b22 = (d22 * inv_den).astype(np.float32)
+            self.b12 = (d12 * inv_den).astype(np.float32)
+
+        self.e1 = e1.astype(np.float32)
+        self.e2 = e2.astype(np.float32)
+        self.normal = normal.astype(np.float32)
+        self.offset = np.einsum('tk,tk->t', normal, p0).astype(np.float32)
+        self.c1 = np.einsum('tk,tk->t', e1, p0).astype(np.float32)
+        self.c2 = np.einsum('tk,tk->t', e2, p0).astype(np.float32)
+
+    def __len__(self):
+        return len(self.triangles)
+
+    def __getitem__(self, index):
+        # A CollisionTriangleRaw for the one triangle a particle hit
+        i0, i1, i2 = self.triangles[index].tolist()
+        return CollisionTriangleRaw(*[om.MVector(*self.points[i].tolist()) for i in (i0, i1, i2)])
+
+    def bounds(self):
+        corners = self.points[self.triangles]
+        lo = corners.min(axis=1).astype(np.float64)
+        hi = corners.max(axis=1).astype(np.float64)
+        # Pad so a hit point rounded onto an edge stays inside its box
+        pad = 1e-5 * np.maximum((hi - lo).max(axis=1), 1.0)[:, np.newaxis]
+        return lo - pad, hi + pad
+
+    def hit_one(self, index, P, V, tmax, t):
+        # CollisionTriangleRaw.hit() for triangle index, reading the tables
+        n = self.normal
+        res1 = P.x * n.item(index, 0) + P.y * n.item(index, 1) + P.z * n.item(index, 2) - self.offset.item(index)
+        nv = V.x * n.item(index, 0) + V.y * n.item(index, 1) + V.z * n.item(index, 2)
+        res2 = res1 - tmax * nv
+        if res1 == 0.0:
+            return False
+        if (res1 * res2) > 0.0:
+            return False
+        t[0] = res1 / nv
+        if (t[0] * tmax < 0) or ((tmax - t[0])/tmax < 1e-6):
+            return False
+
+        x = P.x - V.x * t[0]
+        y = P.y - V.y * t[0]
+        z = P.z - V.z * t[0]
+        e1 = self.e1
+        e2 = self.e2
+        d1w = x * e1.item(index, 0) + y * e1.item(index, 1) + z * e1.item(index, 2) - self.c1.item(index)
+        d2w = x * e2.item(index, 0) + y * e2.item(index, 1) + z * e2.item(index, 2) - self.c2.item(index)
+        u = self.b22.item(index) * d1w - self.b12.item(index) * d2w
+        v = self.b11.item(index) * d2w - self.b12.item(index) * d1w
+        eps = self.edge_epsilon
+        return (-eps <= u) and (u <= 1 + eps) and (-eps <= v) and (v <= 1 + eps) and ((v + u) <= 1 + eps)
+
+    def hit(self, P, V, tmax):
+        P = np.asarray(P, dtype=np.float64).reshape(-1, 3)
+        V = np.asarray(V, dtype=np.float64).reshape(-1, 3)
+        tmax = np.broadcast_to(np.asarray(tmax, dtype=np.float64), (len(P),))
+        t_hit = tmax.copy()
+        tri = np.full(len(P), -1, dtype=np.int64)
+        if len(self.triangles) == 0:
+            return t_hit, tri
+        # About a dozen float64 temporaries per particle/triangle pair
+        block = max(1, self.memory_budget // (len(self.triangles) * 12 * 8))
+        for start in range(0, len(P), block):
+            end = start + block
+            t_hit[start:end], tri[start:end] = self.hit_block(P[start:end], V[start:end],
+                                                              tmax[start:end, np.newaxis])
+        tri[t_hit == -np.inf] = -1
+        t_hit[tri < 0] = tmax[tri < 0]
+        return t_hit, tri
+
+    def hit_pairs(self, P, V, tmax, index):
+        # hit_block() for one triangle per row, the backwards t or -inf for a miss
+        normal = self.normal[index]
+        e1 = self.e1[index]
+        e2 = self.e2[index]
+        res1 = np.einsum('ik,ik->i', P, normal) - self.offset[index]
+        nv = np.einsum('ik,ik->i', V, normal)
+        res2 = res1 - tmax * nv
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = res1 / nv
+            ok = (res1 != 0.0) & ~(res1 * res2 > 0.0)
+            ok &= ~(t * tmax < 0) & ~((tmax - t) / tmax < 1e-6)
+
+            d1w = np.einsum('ik,ik->i', P, e1) - t * np.einsum('ik,ik->i', V, e1) - self.c1[index]
+            d2w = np.einsum('ik,ik->i', P, e2) - t * np.einsum('ik,ik->i', V, e2) - self.c2[index]
+            u = self.b22[index] * d1w - self.b12[index] * d2w
+            v = self.b11[index] * d2w - self.b12[index] * d1w
+            eps = self.edge_epsilon
+            ok &= (u >= -eps) & (u <= 1 + eps) & (v >= -eps) & (v <= 1 + eps) & (u + v <= 1 + eps)
+        return np.where(ok, t, -np.inf)
+
+    def hit_block(self, P, V, tmax):
+        # Moller-Trumbore style: plane crossing of the backward step, then barycentrics,
+        # all as (particles, triangles) dot products against the tables
+        res1 = P.dot(self.normal.T) - self.offset
+        nv = V.dot(self.normal.T)
+        res2 = res1 - tmax * nv
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = res1 / nv
+            ok = (res1 != 0.0) & ~(res1 * res2 > 0.0)
+            ok &= ~(t * tmax < 0) & ~((tmax - t) / tmax < 1e-6)
+
+            d1w = P.dot(self.e1.T) - t * V.dot(self.e1.T) - self.c1
+            d2w = P.dot(self.e2.T) - t * V.dot(self.e2.T) - self.c2
+            u = self.b22 * d1w - self.b12 * d2w
+            v = self.b11 * d2w - self.b12 * d1w
+            eps = self.edge_epsilon
+            ok &= (u >= -eps) & (u <= 1 + eps) & (v >= -eps) & (v <= 1 + eps) & (u + v <= 1 + eps)
+
+        # Largest backwards t, argmax keeps the first triangle on ties like hit()
+        t = np.where(ok, t, -np.inf)
+        index = np.argmax(t, axis=1)
+        return t[np.arange(len(P)), index], index
+
+class CollisionPrimitive(object):
+    """
+    Analytic collider with the hit()/hit_many() interface of CollisionSurfaceRaw.
+    Subclasses give the closed-form backwards times at which P - V * s crosses
+    the surface, crossings(), and the unit normal at a surface point, normal_at(),
+    so a step costs a few float operations per particle instead of a triangle search.
+    """
+
+    def hit_many(self, P, V, tmax):
+        P = np.asarray(P, dtype=np.float64).reshape(-1, 3)
+        V = np.asarray(V, dtype=np.float64).reshape(-1, 3)
+        tmax = np.broadcast_to(np.asarray(tmax, dtype=np.float64), (len(P),))
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            s = self.crossings(P, V)
+            limit = tmax[:, np.newaxis]
+            # Same window as the triangles: after the start of the step, not on the contact just left
+            ok = (s > 0.0) & (s <= limit) & ~((limit - s) / limit < 1e-6)
+        s = np.where(ok, s, -np.inf).max(axis=1)
+        hit = s > -np.inf
+        t = np.where(hit, s, tmax)
+        normal = np.zeros((len(P), 3))
+        normal[hit] = self.normal_at(P[hit] - V[hit] * t[hit][:, np.newaxis])
+        return t, np.where(hit, 0, -1), normal
+
+    def hit(self, P, V, CollData):
+        t, index, normal = self.hit_many([(P.x, P.y, P.z)], [(V.x, V.y, V.z)], CollData['t'])
+        CollData['status'] = bool(index[0] >= 0)
+        if CollData['status']:
+            CollData['t'] = float(t[0])
+            CollData['tri'] = None
+            CollData['normal'] = om.MVector(*normal[0].tolist())
+        return CollData['status']
+
+class CollisionPlane(CollisionPrimitive):
+
+    def __init__(self, point, normal):
+        self.point = np.asarray(point, dtype=np.float64)
+        normal = np.asarray(normal, dtype=np.float64)
+        length = np.sqrt(normal.dot(normal))
+        # A zero normal never crosses anything
+        self.normal = normal / length if length > 0.0 else normal
+
+    def crossings(self, P, V):
+        return ((P - self.point).dot(self.normal) / V.dot(self.normal))[:, np.newaxis]
+
+    def normal_at(self, X):
+        return np.tile(self.normal, (len(X), 1))
+
+class CollisionSphere(CollisionPrimitive):
+
+    def __init__(self, center, radius):
+        self.center = np.asarray(center, dtype=np.float64)
+        self.radius = abs(float(radius))
+
+    @staticmethod
+    def roots(d, V, c):
+        # Both s of |d - V * s|^2 = |d|^2 - c, nan without a real root
+        a = np.einsum('ik,ik->i', V, V)
+        b = np.einsum('ik,ik->i', d, V)
+        root = np.sqrt(b * b - a * c)
+        return np.stack([(b - root) / a, (b + root) / a], axis=1)
+
+    def crossings(self, P, V):
+        d = P - self.center
+        return CollisionSphere.roots(d, V, np.einsum('ik,ik->i', d, d) - self.radius * self.radius)
+
+    def normal_at(self, X):
+        d = X - self.center
+        length = np.sqrt(np.einsum('ik,ik->i', d, d))[:, np.newaxis]
+        return d / np.where(length > 0.0, length, 1.0)
+
+class CollisionBox(CollisionPrimitive):
+    """
+    Axis-aligned box from its center and half size. Along P - V * s each axis
+    is within its slab for an interval of s, the box surface is crossed where
+    the intersection of the three intervals starts and ends.
+    """
+
+    def __init__(self, center, half_size):
+        self.center = np.asarray(center, dtype=np.float64)
+        self.half_size = np.abs(np.asarray(half_size, dtype=np.float64))
+        self.lo = self.center - self.half_size
+        self.hi = self.center + self.half_size
+
+    def crossings(self, P, V):
+        s_lo = (P - self.lo) / V
+        s_hi = (P - self.hi) / V
+        enter = np.minimum(s_lo, s_hi).max(axis=1)
+        leave = np.maximum(s_lo, s_hi).min(axis=1)
+        s = np.stack([enter, leave], axis=1)
+        return np.where((enter <= leave)[:, np.newaxis], s, np.nan)
+
+    def normal_at(self, X):
+        # The face whose plane is closest relative to the box size
+        with np.errstate(divide='ignore', invalid='ignore'):
+            offset = np.abs(X - self.center) / self.half_size
+        axis = np.argmax(np.nan_to_num(offset), axis=1)
+        normal = np.zeros((len(X), 3))
+        normal[np.arange(len(X)), axis] = 1.0
+        return normal
+
+class CollisionCapsule(CollisionPrimitive):
+    """
+    Capsule around the segment a-b: the crossings of the infinite cylinder
+    that land between the ends, and of the end spheres beyond them.
+    """
+
+    def __init__(self, a, b, radius):
+        self.a = np.asarray(a, dtype=np.float64)
+        self.b = np.asarray(b, dtype=np.float64)
+        self.radius = abs(float(radius))
+        axis = self.b - self.a
+        self.length = np.sqrt(axis.dot(axis))
+        # A zero-length capsule is a sphere, every crossing lands on end a
+        self.axis = axis / self.length if self.length > 0.0 else axis
+
+    def crossings(self, P, V):
+        r2 = self.radius * self.radius
+        u = self.axis
+        d = P - self.a
+        dp = d - np.outer(d.dot(u), u)
+        vp = V - np.outer(V.dot(u), u)
+        s = CollisionSphere.roots(dp, vp, np.einsum('ik,ik->i', dp, dp) - r2)
+        h = d.dot(u)[:, np.newaxis] - V.dot(u)[:, np.newaxis] * s
+        s = np.where((h >= 0.0) & (h <= self.length), s, np.nan)
+
+        end_a = CollisionSphere.roots(d, V, np.einsum('ik,ik->i', d, d) - r2)
+        h = d.dot(u)[:, np.newaxis] - V.dot(u)[:, np.newaxis] * end_a
+        end_a = np.where(h <= 0.0, end_a, np.nan)
+        e = P - self.b
+        end_b = CollisionSphere.roots(e, V, np.einsum('ik,ik->i', e, e) - r2)
+        h = e.dot(u)[:, np.newaxis] - V.dot(u)[:, np.newaxis] * end_b
+        end_b = np.where(h >= 0.0, end_b, np.nan)
+        return np.concatenate([s, end_a, end_b], axis=1)
+
+    def normal_at(self, X):
+        h = np.clip((X - self.a).dot(self.axis), 0.0, self.length)
+        d = X - (self.a + np.outer(h, self.axis))
+        length = np.sqrt(np.einsum('ik,ik->i', d, d))[:, np.newaxis]
+        return d / np.where(length > 0.0, length, 1.0)
+
+class CollisionGroup(object):
+    """
+    Several colliders, meshes and primitives, behind one hit()/hit_many():
+    the earliest impact of the step over all of them wins.
+    """
+
+    def __init__(self, colliders):
+        self.colliders = list(colliders)
+
+    def hit_many(self, P, V, tmax):
+        P = np.asarray(P, dtype=np.float64).reshape(-1, 3)
+        tmax = np.broadcast_to(np.asarray(tmax, dtype=np.float64), (len(P),))
+        t_hit = tmax.copy()
+        index = np.full(len(P), -1, dtype=np.int64)
+        normal = np.zeros((len(P), 3))
+        for collider in self.colliders:
+            t, element, n = collider.hit_many(P, V, tmax)
+            better = (element >= 0) & ((index < 0) | (t > t_hit))
+            t_hit[better] = t[better]
+            index[better] = element[better]
+            normal[better] = n[better]
+        return t_hit, index, normal
+
+    def hit(self, P, V, CollData):
+        tmax = CollData['t']
+        status = False
+        for collider in self.colliders:
+            result = dict(CollData, t=tmax)
+            if collider.hit(P, V, result) and (not status or result['t'] > CollData['t']):
+                CollData.update(result)
+                status = True
+        CollData['status'] = status
+        return status
+
+class SweepAndPrune(object):
+    """
+    Broadphase for particle spheres. Their intervals along one axis are kept
+    sorted by lower end between steps with an insertion sort, which is close
+    to linear because the order barely changes from one step to the next.
+    Overlapping intervals are then swept for candidate pairs.
+    """
+    def __init__(self):
+        self.axis = 0
+        self.order = None
+        # Insertion sort moves, a measure of how much the order changed
+        self.swaps = 0
+
+    def sort(self, lo):
+        keys = lo[self.order]
+        if np.all(keys[1:] >= keys[:-1]):
+            return
+        order = self.order.tolist()
+        keys = keys.tolist()
+        for i in range(1, len(keys)):
+            key = keys[i]
+            item = order[i]
+            j = i - 1
+            while j >= 0 and keys[j] > key:
+                keys[j + 1] = keys[j]
+                order[j + 1] = order[j]
+                j -= 1
+            keys[j + 1] = key
+            order[j + 1] = item
+            self.swaps += i - 1 - j
+        self.order = np.array(order, dtype=np.int64)
+
+    def pairs(self, pos, radii, awake=None):
+        """
+        Index pairs (i, j) of particles whose bounding boxes overlap. Given an
+        awake mask, only pairs with at least one awake particle are returned,
+        found by querying the sorted intervals around each awake particle.
+        """
+        count = len(pos)
+        if self.order is None or len(self.order) != count:
+            # Full sort on the axis with the most spread whenever the particle count changes
+            self.axis = int(np.argmax(pos.max(axis=0) - pos.min(axis=0))) if count else 0
+            self.order = np.argsort(pos[:, self.axis] - radii, kind='mergesort')
+        else:
+            self.sort(pos[:, self.axis] - radii)
+
+        lo = (pos[:, self.axis] - radii)[self.order]
+        hi = (pos[:, self.axis] + radii)[self.order]
+        if awake is None or np.all(awake):
+            # Each interval overlaps the ones after it that start before it ends
+            start = np.arange(count) + 1
+            end = np.searchsorted(lo, hi, side='right')
+            rows = self.order
+        else:
+            # Intervals starting between one diameter before an awake one and its end
+            rows = np.flatnonzero(awake)
+            start = np.searchsorted(lo, pos[rows, self.axis] - radii[rows] - 2.0 * radii.max(), side='left')
+            end = np.searchsorted(lo, pos[rows, self.axis] + radii[rows], side='right')
+        counts = np.maximum(end - start, 0)
+        i = np.repeat(rows, counts)
+        j = self.order[np.repeat(start, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+        if awake is not None and not np.all(awake):
+            # Drop self pairs and the second copy of pairs of two awake particles
+            keep = (i != j) & (~awake[j] | (i < j))
+            i = i[keep]
+            j = j[keep]
+        overlap = np.all(np.abs(pos[j] - pos[i]) <= (radii[i] + radii[j])[:, np.newaxis], axis=1)
+        return i[overlap], j[overlap]
+
+def trilinear(grid, origin, cell, points):
+    """
+    Trilinear interpolation of grid values shaped (nx, ny, nz, channels), with
+    lower corner origin and per-axis cell size, at points shaped (n, 3). Points
+    outside the grid read the nearest boundary value.
+    """
+    shape = np.array(grid.shape[:3])
+    u = np.clip((points - origin) / cell, 0.0, shape - 1)
+    i0 = np.minimum(np.floor(u).astype(np.int64), np.maximum(shape - 2, 0))
+    f = u - i0
+    result = np.zeros((len(points),) + grid.shape[3:], dtype=np.float32)
+    for dx in (0, 1):
+        wx = f[:, 0] if dx else 1.0 - f[:, 0]
+        for dy in (0, 1):
+            wy = f[:, 1] if dy else 1.0 - f[:, 1]
+            for dz in (0, 1):
+                wz = f[:, 2] if dz else 1.0 - f[:, 2]
+                corner = grid[np.minimum(i0[:, 0] + dx, shape[0] - 1),
+                              np.minimum(i0[:, 1] + dy, shape[1] - 1),
+                              np.minimum(i0[:, 2] + dz, shape[2] - 1)]
+                w = wx * wy * wz
+                result += w.reshape((-1,) + (1,) * (corner.ndim - 1)) * corner
+    return result
+
+class ForceFieldGrid(object):
+    """
+    Wind, a vortex around an axis and curl noise summed into one acceleration
+    grid over a box around the origin. The grid is rebuilt only when a field
+    parameter or its layout changes, after which every particle gets its field
+    force from one trilinear lookup however expensive the fields are.
+    """
+    NOISE_WAVES = 4
+
+    def __init__(self):
+        self.key = None
+        self.grid = None
+        self.origin = None
+        self.cell = None
+        self.builds = 0
+
+    def update(self, wind, vortex_center, vortex_axis, vortex_strength,
+               noise_amplitude, noise_frequency, noise_seed, extent, resolution):
+        key = (tuple(wind), tuple(vortex_center), tuple(vortex_axis), vortex_strength,
+               noise_amplitude, noise_frequency, noise_seed, extent, resolution)
+        if self.grid is not None and key == self.key:
+            return False
+        self.key = key
+        self.build(max(2, resolution), extent)
+        self.builds += 1
+        return True
+
+    def build(self, resolution, extent):
+        wind, center, axis, strength, amplitude, frequency, seed = [np.array(v, dtype=np.float64)
+                                                                  for v in self.key[:7]]
+        self.origin = np.full(3, -extent, dtype=np.float64)
+        self.cell = np.full(3, max(2.0 * extent / (resolution - 1), 1e-6))
+        axes = [self.origin[k] + self.cell[k] * np.arange(resolution) for k in range(3)]
+        points = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1)
+
+        field = np.zeros_like(points) + wind
+
+        # Swirl around the axis through center, strongest one unit away from it
+        axis_length = np.sqrt(axis.dot(axis))
+        if strength != 0.0 and axis_length > 0.0:
+            swirl = np.cross(axis / axis_length, points - center)
+            r = np.sqrt(np.einsum('...k,...k->...', swirl, swirl))[..., np.newaxis]
+            field += strength * swirl / (1.0 + r * r)
+
+        # Curl of a smooth random vector potential, divergence free so it stirs without sinks
+        if amplitude != 0.0:
+            rng = np.random.RandomState(int(seed))
+            potential = np.zeros_like(points)
+            for k in range(3):
+                for wave in range(self.NOISE_WAVES):
+                    direction = rng.normal(size=3)
+                    direction *= frequency * (wave + 1) / np.sqrt(direction.dot(direction))
+                    potential[..., k] += np.sin(points.dot(direction) + rng.uniform(0.0, 2.0 * np.pi)) / (wave + 1)
+            d = [np.gradient(potential[..., k], *self.cell.tolist()) for k in range(3)]
+            field[..., 0] += amplitude * (d[2][1] - d[1][2])
+            field[..., 1] += amplitude * (d[0][2] - d[2][0])
+            field[..., 2] += amplitude * (d[1][0] - d[0][1])
+        self.grid = field.astype(np.float32)
+
+    def sample(self, points):
+        return trilinear(self.grid, self.origin, self.cell, points)
+
 class GravityNode(om.MPxNode):
 
     TYPE_NAME = "gravitynode"
@@ -93,6 +883,45 @@ class GravityNode(om.MPxNode):
     aTime = None
     position = None
     reset = None
+    collider = None
+    maxIterations = None
+    budgetHits = None
+    particleCount = None
+    positions = None
+    output = None
+    particleRadius = None
+    radiusPP = None
+    sleepVelocity = None
+    sleepFrames = None
+    sleepingCount = None
+    wind = None
+    vortexCenter = None
+    vortexAxis = None
+    vortexStrength = None
+    noiseAmplitude = None
+    noiseFrequency = None
+    noiseSeed = None
+    fieldResolution = None
+    fieldExtent = None
+    primitives = None
+    primitiveType = None
+    primitivePoint = None
+    primitiveVector = None
+    primitiveRadius = None
+    restitution = None
+    sticky = None
+
+    # The built-in cube collider, shared by every node without a collider mesh or primitive
+    _defaultSurface = None
+
+    @classmethod
+    def defaultSurface(cls):
+        if cls._defaultSurface is None:
+            if np is not None:
+                cls._defaultSurface = CollisionBox((0.0, 0.0, 0.0), (11.8, 11.8, 11.8))
+            else:
+                cls._defaultSurface = CollisionSurfaceRaw(GenerateCollisionCube(11.8))
+        return cls._defaultSurface
 
     def __init__(self):
         super(GravityNode, self).__init__()
@@ -109,36 +938,372 @@ class GravityNode(om.MPxNode):
         
         self.coeff_sticky = 1.0
         self.coeff_restitution = 1.0
-        self.cube = GenerateCollisionCube(11.8)
-        self.surf = CollisionSurfaceRaw(self.cube)
-        self.cube2 = GenerateCollisionCube(25.0)
+        self.surf = GravityNode.defaultSurface()
         self.dt = 0.1
+        self.max_iterations = 8
+        # Bounces restart this far off the surface, on the side the particle came from, so
+        # the next search does not start on the plane it just left and hit it again
+        self.contact_offset = 1e-4
+        # Steps that ran out of collision iterations and fell back to clamping
+        self.budget_hits = 0
+        # Triangles and points of the collider mesh without NumPy, with it the tables of _meshSurface
+        self._colliderTriangles = None
+        self._colliderPoints = None
+        self._meshSurface = None
+        # Analytic colliders built from the primitives attribute, keyed by its values
+        self._primitiveKey = ()
+        self._primitives = []
+        self._stepTime = None
+
+        # Array mode, (N, 3) positions and velocities with particle 0 on translate.
+        # Without NumPy the node simulates the single MVector particle above.
+        self._positions = None
+        self._velocities = None
+        # Particle radii, particles only collide with each other when some are above zero
+        self._radii = None
+        self.sweep = None
+        # Rest detection: particles slower than sleep_velocity that touched something in
+        # the last step, for sleep_frames steps in a row, stop being simulated until woken
+        self.sleep_velocity = 0.2
+        self.sleep_frames = 10
+        self._asleep = None
+        self._restFrames = None
+        self._contactAge = None
+        self._restForces = None
+        # Cached wind/vortex/noise grid, None while every field is off
+        self.field = None
+        if np is not None:
+            self.sweep = SweepAndPrune()
+            self._positions = np.zeros((1, 3))
+            self._velocities = np.array([[vel_x, vel_y, vel_z]])
+            self._asleep = np.zeros(1, dtype=bool)
+            self._restFrames = np.zeros(1, dtype=np.int64)
+            self._contactAge = np.zeros(1, dtype=np.int64)
 
     def resetParameter(self):
         self._gravity = om.MVector(0.0, -1.0, 0.0)
         self._accelerate = om.MVector(0.0, 0.0, 0.0)
         self._velocity = om.MVector(0.0, 0.0, 0.0)
         self._position = om.MVector(0.0, 0.0, 0.0)
+        if np is not None:
+            self._positions[:] = 0.0
+            self._velocities[:] = 0.0
+            self.wakeParticles()
+
+    def wakeParticles(self):
+        if np is not None:
+            self._asleep[:] = False
+            self._restFrames[:] = 0
+
+    def resizeParticles(self, count):
+        if np is None or count == len(self._positions):
+            return
+        if count < len(self._positions):
+            self._positions = self._positions[:count].copy()
+            self._velocities = self._velocities[:count].copy()
+            self._asleep = self._asleep[:count].copy()
+            self._restFrames = self._restFrames[:count].copy()
+            self._contactAge = self._contactAge[:count].copy()
+            return
+        # New particles start awake at the origin with a random velocity, like particle 0
+        added = count - len(self._positions)
+        self._positions = np.concatenate([self._positions, np.zeros((added, 3))])
+        self._velocities = np.concatenate([self._velocities, np.random.uniform(-1.0, 1.0, (added, 3))])
+        self._asleep = np.concatenate([self._asleep, np.zeros(added, dtype=bool)])
+        self._restFrames = np.concatenate([self._restFrames, np.zeros(added, dtype=np.int64)])
+        self._contactAge = np.concatenate([self._contactAge, np.zeros(added, dtype=np.int64)])
+
+    def updateRadii(self, data):
+        if np is None:
+            return
+        radii = np.full(len(self._positions), data.inputValue(self.particleRadius).asFloat())
+        per_particle = om.MFnDoubleArrayData(data.inputValue(self.radiusPP).data()).array()
+        count = min(len(per_particle), len(radii))
+        radii[:count] = list(per_particle)[:count]
+        self._radii = radii
+
+    def updateFields(self, data):
+        if np is None:
+            return
+        wind = data.inputValue(self.wind).asFloatVector()
+        vortex_strength = data.inputValue(self.vortexStrength).asFloat()
+        noise_amplitude = data.inputValue(self.noiseAmplitude).asFloat()
+        resolution = data.inputValue(self.fieldResolution).asInt()
+        if resolution == 0 or (wind.length() == 0.0 and vortex_strength == 0.0 and noise_amplitude == 0.0):
+            self.field = None
+            return
+        if self.field is None:
+            self.field = ForceFieldGrid()
+        center = data.inputValue(self.vortexCenter).asFloatVector()
+        axis = data.inputValue(self.vortexAxis).asFloatVector()
+        # Only rebaked when a parameter or the grid layout changed
+        self.field.update((wind.x, wind.y, wind.z), (center.x, center.y, center.z), (axis.x, axis.y, axis.z),
+                          vortex_strength, noise_amplitude, data.inputValue(self.noiseFrequency).asFloat(),
+                          data.inputValue(self.noiseSeed).asInt(), data.inputValue(self.fieldExtent).asFloat(),
+                          resolution)
+
+    def particlePositions(self):
+        if np is None:
+            return [(self._position.x, self._position.y, self._position.z)]
+        return self._positions.tolist()
+
+    def updateCollider(self, data):
+        changed = self.updateMeshCollider(data)
+        changed = self.updatePrimitives(data) or changed
+        if not changed:
+            return
+        colliders = self._primitives if self._meshSurface is None else [self._meshSurface] + self._primitives
+        if not colliders:
+            self.surf = GravityNode.defaultSurface()
+        elif len(colliders) == 1:
+            self.surf = colliders[0]
+        else:
+            self.surf = CollisionGroup(colliders)
+        self.wakeParticles()
+
+    def updateMeshCollider(self, data):
+        mesh = data.inputValue(self.collider).asMesh()
+        if mesh.isNull():
+            if self._meshSurface is None:
+                return False
+            self._colliderTriangles = None
+            self._colliderPoints = None
+            self._meshSurface = None
+            return True
+
+        fn_mesh = om.MFnMesh(mesh)
+        counts, vertices = fn_mesh.getTriangles()
+        points = fn_mesh.getPoints(om.MSpace.kObject)
+        if np is not None:
+            # Compared against the collider's own int32/float32 tables, nothing else keeps the mesh
+            triangles = np.array(vertices, dtype=np.int32).reshape(-1, 3)
+            points = np.array(points, dtype=np.float64).reshape(-1, 4)[:, :3].astype(np.float32)
+            table = None if self._meshSurface is None else self._meshSurface.arrays
+            topology = table is not None and np.array_equal(triangles, table.triangles)
+            moved = not topology or not np.array_equal(points, table.points)
+            if not topology:
+                self._meshSurface = CollisionSurfaceRaw(MeshTriangles(points, triangles))
+            elif moved:
+                self._meshSurface.move_points(points, triangles)
+            return moved
+
+        triangles = list(zip(vertices[0::3], vertices[1::3], vertices[2::3]))
+        points = [(p.x, p.y, p.z) for p in points]
+        if triangles != self._colliderTriangles:
+            self._colliderTriangles = triangles
+            self._colliderPoints = points
+            self._meshSurface = CollisionSurfaceRaw(MeshTriangles(points, self._colliderTriangles))
+            return True
+        if points != self._colliderPoints:
+            # Deformed but same topology, move the triangles and refit the hierarchy in place
+            self._colliderPoints = points
+            self._meshSurface.move_points(points, self._colliderTriangles)
+            return True
+        return False
+
+    def updatePrimitives(self, data):
+        if np is None:
+            return False
+        primitives_handle = data.inputArrayValue(self.primitives)  #type: om.MArrayDataHandle
+        rows = []
+        for physicalIndex in range(len(primitives_handle)):
+            primitives_handle.jumpToPhysicalElement(physicalIndex)
+            primitive_handle = primitives_handle.inputValue()
+            point = primitive_handle.child(self.primitivePoint).asFloatVector()
+            vector = primitive_handle.child(self.primitiveVector).asFloatVector()
+            rows.append((primitive_handle.child(self.primitiveType).asShort(), (point.x, point.y, point.z),
+                         (vector.x, vector.y, vector.z), primitive_handle.child(self.primitiveRadius).asFloat()))
+        key = tuple(rows)
+        if key == self._primitiveKey:
+            return False
+        self._primitiveKey = key
+        self._primitives = [PrimitiveCollider(*row) for row in rows]
+        return True
 
     def handleCollisions(self, dt):
-        CollData = {'t': dt, 'tri': None, 'status': False}
+        # hit() reports the earliest impact of the step (the largest backwards t) and each
+        # bounce only searches the time left after it, so impacts resolve in time order
+        CollData = {'t': dt, 'tri': None, 'normal': None, 'status': False}
+        iterations = 0
         while self.surf.hit(self._position, self._velocity, CollData):
             t = CollData['t']
-            tri = CollData['tri']
-            norm = tri.normal
+            norm = CollData['normal']
             vn = norm * self._velocity
             vp = self._velocity - norm * vn
+            xc = self._position - self._velocity * t
+
+            iterations += 1
+            if iterations >= self.max_iterations:
+                # Out of budget, e.g. wedged in a corner: clamp to the contact point on the
+                # side the particle came from and project out the velocity into the surface
+                side = 1.0 if vn < 0.0 else -1.0
+                self._position = xc + norm * (side * self.contact_offset)
+                self._velocity = self.coeff_sticky * vp
+                self.budget_hits += 1
+                return
+
             vr = (self.coeff_sticky * vp) - (self.coeff_restitution * norm * vn)
 
             # Set new point
-            xc = self._position - self._velocity * t
-            x = xc + vr * t
+            side = 1.0 if vn < 0.0 else -1.0
+            x = xc + norm * (side * self.contact_offset) + vr * t
             #om.MGlobal.displayInfo("Pos: {0}, Vel: {1}".format(self._position, self._velocity))
             self._position = x
             self._velocity = vr
 
+    def handleCollisionsArray(self, dt, active):
+        # handleCollisions() for the active particles at once, each pass only
+        # testing the particles that bounced in the previous one
+        P = self._positions
+        V = self._velocities
+        remaining = np.full(len(P), dt)
+        for iteration in range(1, self.max_iterations + 1):
+            if len(active) == 0:
+                return
+            t, tri, norm = self.surf.hit_many(P[active], V[active], remaining[active])
+            hit = tri >= 0
+            active = active[hit]
+            self._contactAge[active] = 0
+            t = t[hit][:, np.newaxis]
+            norm = norm[hit]
+            vel = V[active]
+            vn = np.einsum('ik,ik->i', norm, vel)[:, np.newaxis]
+            vp = vel - norm * vn
+            xc = P[active] - vel * t
+            side = np.where(vn < 0.0, 1.0, -1.0)
+            xc += norm * (side * self.contact_offset)
+
+            if iteration == self.max_iterations:
+                # Out of budget, clamp and project like handleCollisions()
+                P[active] = xc
+                V[active] = self.coeff_sticky * vp
+                self.budget_hits += len(active)
+                return
+
+            vr = (self.coeff_sticky * vp) - (self.coeff_restitution * norm * vn)
+            P[active] = xc + vr * t
+            V[active] = vr
+            remaining[active] = t[:, 0]
+
+    def handleParticleCollisions(self):
+        # Separate overlapping spheres and exchange the approaching part of their
+        # velocity along the contact normal, equal masses, one Jacobi pass
+        P = self._positions
+        V = self._velocities
+        radii = self._radii
+        if radii is None or len(P) < 2 or not np.any(radii > 0.0):
+            return
+        # Two sleeping particles stay as they are, a settled pile costs nothing
+        i, j = self.sweep.pairs(P, radii, ~self._asleep)
+        d = P[j] - P[i]
+        dist = np.sqrt(np.einsum('ik,ik->i', d, d))
+        overlap = radii[i] + radii[j] - dist
+        contact = overlap > 0.0
+        i, j, d, dist, overlap = i[contact], j[contact], d[contact], dist[contact], overlap[contact]
+        if len(i) == 0:
+            return
+        self._contactAge[i] = 0
+        self._contactAge[j] = 0
+
+        # Coincident particles are split along x
+        norm = np.tile([1.0, 0.0, 0.0], (len(i), 1))
+        apart = dist > 0.0
+        norm[apart] = d[apart] / dist[apart][:, np.newaxis]
+        vrel = np.einsum('ik,ik->i', V[j] - V[i], norm)
+
+        # A sleeping particle hit hard enough wakes up, otherwise it does not move
+        woken = vrel < -self.sleep_velocity
+        self._asleep[i[woken]] = False
+        self._asleep[j[woken]] = False
+        impulse = (np.where(vrel < 0.0, -0.5 * (1.0 + self.coeff_restitution) * vrel, 0.0)[:, np.newaxis]) * norm
+        push = norm * (0.5 * overlap)[:, np.newaxis]
+
+        dv = np.zeros_like(V)
+        dp = np.zeros_like(P)
+        np.add.at(dv, i, -impulse)
+        np.add.at(dv, j, impulse)
+        np.add.at(dp, i, -push)
+        np.add.at(dp, j, push)
+        dv[self._asleep] = 0.0
+        dp[self._asleep] = 0.0
+        V += dv
+
+        # Sweep the pushes against the collider too, lengthened by the contact offset, so
+        # they stop that far off a surface instead of crossing or ending right on it
+        moved = np.flatnonzero(np.any(dp != 0.0, axis=1))
+        push = dp[moved]
+        length = np.sqrt(np.einsum('ik,ik->i', push, push))[:, np.newaxis]
+        sweep = push * (1.0 + self.contact_offset / length)
+        target = P[moved] + sweep
+        t, tri, norm = self.surf.hit_many(target, sweep, 1.0)
+        blocked = tri >= 0
+        P[moved[~blocked]] += push[~blocked]
+        norm = norm[blocked]
+        sweep = sweep[blocked]
+        side = np.where(np.einsum('ik,ik->i', norm, sweep) < 0.0, 1.0, -1.0)[:, np.newaxis]
+        P[moved[blocked]] = target[blocked] - sweep * t[blocked][:, np.newaxis] + norm * (side * self.contact_offset)
+
+    def step(self, dt):
+        self._accelerate = self._gravity / self._mass
+        if np is None:
+            self._position += self._velocity * dt
+            self.handleCollisions(dt)
+            self._velocity += self._accelerate * dt
+            return
+        accelerate = np.array([self._accelerate.x, self._accelerate.y, self._accelerate.z])
+        forces = (tuple(accelerate), None if self.field is None else self.field.key)
+        if forces != self._restForces or self.sleep_frames <= 0:
+            # Particles rest under the forces they settled with
+            self._restForces = forces
+            self.wakeParticles()
+
+        live = np.flatnonzero(~self._asleep)
+        if len(live) == 0:
+            return
+        self._positions[live] += self._velocities[live] * dt
+        self._contactAge[live] += 1
+        self.handleCollisionsArray(dt, live)
+        self.handleParticleCollisions()
+        live = np.flatnonzero(~self._asleep)
+        if self.field is not None:
+            accelerate = accelerate + self.field.sample(self._positions[live]) / self._mass
+        self._velocities[live] += accelerate * dt
+        self.updateSleep(live)
+
+    def updateSleep(self, live):
+        if self.sleep_frames <= 0:
+            return
+        velocities = self._velocities[live]
+        speed = np.sqrt(np.einsum('ik,ik->i', velocities, velocities))
+        resting = (speed < self.sleep_velocity) & (self._contactAge[live] <= 1)
+        self._restFrames[live] = np.where(resting, self._restFrames[live] + 1, 0)
+        settled = live[self._restFrames[live] >= self.sleep_frames]
+        self._asleep[settled] = True
+        self._velocities[settled] = 0.0
+
+    def updateOutput(self, plug, data):
+        positions = self.particlePositions()
+        if plug == GravityNode.positions:
+            vector_array = om.MVectorArray([om.MVector(*p) for p in positions])
+            data.outputValue(GravityNode.positions).setMObject(om.MFnVectorArrayData().create(vector_array))
+        elif plug == GravityNode.output:
+            output_array_handle = data.outputArrayValue(GravityNode.output)  #type: om.MArrayDataHandle
+            builder = om.MArrayDataBuilder(data, GravityNode.output, len(positions))
+            for index, p in enumerate(positions):
+                builder.addElement(index).set3Float(p[0], p[1], p[2])
+            output_array_handle.set(builder)
+            output_array_handle.setAllClean()
+        else:
+            p = positions[0] if positions else (0.0, 0.0, 0.0)
+            position_data_handle = data.outputValue(GravityNode.position)
+            position_data_handle.setMFloatVector(om.MFloatVector(p[0], p[1], p[2]))
+            position_data_handle.setClean()
+
     def compute(self, plug, data):
-        if plug != GravityNode.position:
+        if plug.isElement:
+            plug = plug.array()
+        if plug not in (GravityNode.position, GravityNode.positions, GravityNode.output, GravityNode.budgetHits,
+                        GravityNode.sleepingCount):
             return
 
         # Get the inputs
@@ -156,19 +1321,37 @@ class GravityNode(om.MPxNode):
         if timeDifference > 1.0 or timeDifference < 0.0:
             self._initialized = False
             self._previousTime = currentTime
+            self._stepTime = None
             data.setClean(plug)
             return
 
         self._previousTime = om.MTime(currentTime)
-        self._accelerate = self._gravity / self._mass
-        self._position += self._velocity * self.dt
-        self.handleCollisions(self.dt)
-        self._velocity += self._accelerate * self.dt
-
-        position_data_handle = data.outputValue(GravityNode.position)
-        outVector = om.MFloatVector(self._position.x, self._position.y, self._position.z)
-        position_data_handle.setMFloatVector(outVector)
-        position_data_handle.setClean()
+
+        # Every output pulled at the same time shares one step
+        if self._stepTime != currentTime.value:
+            self._stepTime = currentTime.value
+            self.updateCollider(data)
+            self.max_iterations = data.inputValue(self.maxIterations).asInt()
+            self.resizeParticles(data.inputValue(self.particleCount).asInt())
+            self.updateRadii(data)
+            self.updateFields(data)
+            self.sleep_velocity = data.inputValue(self.sleepVelocity).asFloat()
+            self.sleep_frames = data.inputValue(self.sleepFrames).asInt()
+            self.coeff_restitution = data.inputValue(self.restitution).asFloat()
+            self.coeff_sticky = data.inputValue(self.sticky).asFloat()
+            self.step(self.dt)
+
+        # The counters are written below for every plug
+        if plug != GravityNode.budgetHits and plug != GravityNode.sleepingCount:
+            self.updateOutput(plug, data)
+
+        budget_data_handle = data.outputValue(GravityNode.budgetHits)
+        budget_data_handle.setInt(self.budget_hits)
+        budget_data_handle.setClean()
+
+        sleeping_data_handle = data.outputValue(GravityNode.sleepingCount)
+        sleeping_data_handle.setInt(0 if np is None else int(self._asleep.sum()))
+        sleeping_data_handle.setClean()
         data.setClean(plug)
 
     @classmethod
@@ -179,6 +1362,9 @@ class GravityNode(om.MPxNode):
     def initialize(cls):
         numeric_attr = om.MFnNumericAttribute()
         unit_attr = om.MFnUnitAttribute()
+        typed_attr = om.MFnTypedAttribute()
+        enum_attr = om.MFnEnumAttribute()
+        compound_attr = om.MFnCompoundAttribute()
 
         cls.aTime = unit_attr.create('time', 'time', om.MFnUnitAttribute.kTime, 0.0)
         unit_attr.keyable = True
@@ -188,12 +1374,145 @@ class GravityNode(om.MPxNode):
 
         cls.reset = numeric_attr.create("reset", "reset", om.MFnNumericData.kBoolean, 0)
 
+        # Collides against the built-in cube when neither a mesh nor a primitive is given
+        cls.collider = typed_attr.create("collider", "collider", om.MFnData.kMesh)
+        typed_attr.storable = False
+
+        cls.maxIterations = numeric_attr.create("maxCollisionIterations", "maxCollisionIterations", om.MFnNumericData.kInt, 8)
+        numeric_attr.setMin(1)
+
+        cls.budgetHits = numeric_attr.create("collisionBudgetHits", "collisionBudgetHits", om.MFnNumericData.kInt, 0)
+        numeric_attr.writable = False
+        numeric_attr.storable = False
+
+        cls.particleCount = numeric_attr.create("particleCount", "particleCount", om.MFnNumericData.kInt, 1)
+        numeric_attr.setMin(0)
+
+        # Every particle in one vectorArray, and per particle for direct connections
+        cls.positions = typed_attr.create("positions", "positions", om.MFnData.kVectorArray, om.MFnVectorArrayData().create())
+        typed_attr.writable = False
+        typed_attr.storable = False
+
+        cls.output = numeric_attr.createPoint("output", "output")
+        numeric_attr.array = True
+        numeric_attr.writable = False
+        numeric_attr.storable = False
+        numeric_attr.usesArrayDataBuilder = True
+
+        cls.particleRadius = numeric_attr.create("particleRadius", "particleRadius", om.MFnNumericData.kFloat, 0.0)
+        numeric_attr.setMin(0.0)
+
+        # Per-particle radii overriding particleRadius for the first len(radiusPP) particles
+        cls.radiusPP = typed_attr.create("radiusPP", "radiusPP", om.MFnData.kDoubleArray, om.MFnDoubleArrayData().create())
+
+        cls.sleepVelocity = numeric_attr.create("sleepVelocity", "sleepVelocity", om.MFnNumericData.kFloat, 0.2)
+        numeric_attr.setMin(0.0)
+
+        # Steps a particle has to rest before it sleeps, 0 keeps every particle awake
+        cls.sleepFrames = numeric_attr.create("sleepFrames", "sleepFrames", om.MFnNumericData.kInt, 10)
+        numeric_attr.setMin(0)
+
+        cls.sleepingCount = numeric_attr.create("sleepingCount", "sleepingCount", om.MFnNumericData.kInt, 0)
+        numeric_attr.writable = False
+        numeric_attr.storable = False
+
+        # Fraction of the normal velocity kept by a bounce, below 1 particles lose energy and can come to rest
+        cls.restitution = numeric_attr.create("restitution", "restitution", om.MFnNumericData.kFloat, 1.0)
+        numeric_attr.keyable = True
+        numeric_attr.setMin(0.0)
+        numeric_attr.setMax(1.0)
+
+        # Fraction of the tangential velocity kept by a bounce
+        cls.sticky = numeric_attr.create("sticky", "sticky", om.MFnNumericData.kFloat, 1.0)
+        numeric_attr.keyable = True
+        numeric_attr.setMin(0.0)
+        numeric_attr.setMax(1.0)
+
+        cls.wind = numeric_attr.createPoint("wind", "wind")
+        numeric_attr.keyable = True
+
+        cls.vortexCenter = numeric_attr.createPoint("vortexCenter", "vortexCenter")
+
+        cls.vortexAxis = numeric_attr.createPoint("vortexAxis", "vortexAxis")
+        numeric_attr.default = (0.0, 1.0, 0.0)
+
+        cls.vortexStrength = numeric_attr.create("vortexStrength", "vortexStrength", om.MFnNumericData.kFloat, 0.0)
+        numeric_attr.keyable = True
+
+        cls.noiseAmplitude = numeric_attr.create("noiseAmplitude", "noiseAmplitude", om.MFnNumericData.kFloat, 0.0)
+        numeric_attr.keyable = True
+
+        cls.noiseFrequency = numeric_attr.create("noiseFrequency", "noiseFrequency", om.MFnNumericData.kFloat, 0.2)
+        numeric_attr.setMin(0.0)
+
+        cls.noiseSeed = numeric_attr.create("noiseSeed", "noiseSeed", om.MFnNumericData.kInt, 0)
+        numeric_attr.setMin(0)
+
+        # Samples per axis of the baked field grid, 0 turns the fields off
+        cls.fieldResolution = numeric_attr.create("fieldResolution", "fieldResolution", om.MFnNumericData.kInt, 24)
+        numeric_attr.setMin(0)
+
+        # Half size of the grid box around the origin, outside it the boundary values apply
+        cls.fieldExtent = numeric_attr.create("fieldExtent", "fieldExtent", om.MFnNumericData.kFloat, 12.0)
+        numeric_attr.setMin(0.001)
+
+        # Analytic colliders, used alongside the collider mesh
+        cls.primitiveType = enum_attr.create("primitiveType", "primitiveType", 0)
+        enum_attr.addField("Plane", 0)
+        enum_attr.addField("Box", 1)
+        enum_attr.addField("Sphere", 2)
+        enum_attr.addField("Capsule", 3)
+
+        # Plane point, box and sphere center, capsule end A
+        cls.primitivePoint = numeric_attr.createPoint("primitivePoint", "primitivePoint")
+
+        # Plane normal, box half size, capsule end B
+        cls.primitiveVector = numeric_attr.createPoint("primitiveVector", "primitiveVector")
+        numeric_attr.default = (0.0, 1.0, 0.0)
+
+        cls.primitiveRadius = numeric_attr.create("primitiveRadius", "primitiveRadius", om.MFnNumericData.kFloat, 1.0)
+        numeric_attr.setMin(0.0)
+
+        cls.primitives = compound_attr.create("primitives", "primitives")
+        for child in (cls.primitiveType, cls.primitivePoint, cls.primitiveVector, cls.primitiveRadius):
+            compound_attr.addChild(child)
+        compound_attr.array = True
+
         cls.addAttribute(cls.position)
         cls.addAttribute(cls.aTime)
         cls.addAttribute(cls.reset)
+        cls.addAttribute(cls.collider)
+        cls.addAttribute(cls.maxIterations)
+        cls.addAttribute(cls.budgetHits)
+        cls.addAttribute(cls.particleCount)
+        cls.addAttribute(cls.positions)
+        cls.addAttribute(cls.output)
+        cls.addAttribute(cls.particleRadius)
+        cls.addAttribute(cls.radiusPP)
+        cls.addAttribute(cls.sleepVelocity)
+        cls.addAttribute(cls.sleepFrames)
+        cls.addAttribute(cls.sleepingCount)
+        cls.addAttribute(cls.restitution)
+        cls.addAttribute(cls.sticky)
+        cls.addAttribute(cls.wind)
+        cls.addAttribute(cls.vortexCenter)
+        cls.addAttribute(cls.vortexAxis)
+        cls.addAttribute(cls.vortexStrength)
+        cls.addAttribute(cls.noiseAmplitude)
+        cls.addAttribute(cls.noiseFrequency)
+        cls.addAttribute(cls.noiseSeed)
+        cls.addAttribute(cls.fieldResolution)
+        cls.addAttribute(cls.fieldExtent)
+        cls.addAttribute(cls.primitives)
 
         cls.attributeAffects(cls.aTime, cls.position)
         cls.attributeAffects(cls.reset, cls.position)
+        cls.attributeAffects(cls.aTime, cls.positions)
+        cls.attributeAffects(cls.reset, cls.positions)
+        cls.attributeAffects(cls.aTime, cls.output)
+        cls.attributeAffects(cls.reset, cls.output)
+        cls.attributeAffects(cls.aTime, cls.budgetHits)
+        cls.attributeAffects(cls.aTime, cls.sleepingCount)
 
 def GenerateCollisionCube(size):
     verts = []
@@ -251,6 +1570,22 @@ def GenerateCollisionCube(size):
         surfs.append(tri2)
     return surfs
 
+def MeshTriangles(points, triangles):
+    # Contiguous tables when NumPy is available, one object per triangle otherwise
+    if np is not None:
+        return CollisionTriangleArrays(points, triangles)
+    return [CollisionTriangleRaw(om.MVector(*points[i0]), om.MVector(*points[i1]), om.MVector(*points[i2]))
+            for i0, i1, i2 in triangles]
+
+def PrimitiveCollider(kind, point, vector, radius):
+    # One row of the primitives attribute: plane, box, sphere or capsule
+    if kind == 0:
+        return CollisionPlane(point, vector)
+    if kind == 1:
+        return CollisionBox(point, vector)
+    if kind == 2:
+        return CollisionSphere(point, radius)
+    return CollisionCapsule(point, vector, radius)
 
 def initializePlugin(plugin):
     vecdor = "Xicheng"
@@ -0,0 +1,392 @@
+import maya.api.OpenMaya as om
+import maya.api.OpenMayaAnim as oma
+import maya.cmds as cmds
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def maya_useNewAPI():
+    """
+    The presence of this function tells Maya that the plugin produces, and
+    expects to be passed, object created using the Maya Python API 2.0.
+    """
+    pass
+
+class JiggleState(object):
+    """
+    The JigglePoint integrator for many points at once. Current and previous
+    positions are (N, 3) arrays, step() advances the given rows one frame
+    towards their goals and leaves every other row as it is.
+    """
+
+    def __init__(self, goal):
+        self.time = None
+        self.reset(goal)
+
+    def __len__(self):
+        return len(self.current)
+
+    def reset(self, goal):
+        self.current = np.array(goal, dtype=np.float64).reshape(-1, 3)
+        self.previous = self.current.copy()
+
+    def step(self, goal, damping, stiffness, rows=slice(None)):
+        # damping and stiffness are shared, or one per row shaped (n, 1)
+        current = self.current[rows]
+        velocity = (current - self.previous[rows]) * (1.0 - damping)
+        position = current + velocity
+        position += (goal - position) * stiffness
+        self.previous[rows] = current
+        self.current[rows] = position
+        return position
+
+def MatrixArray(matrix):
+    return np.array(list(matrix), dtype=np.float64).reshape(4, 4)
+
+def TransformPoints(points, matrix):
+    # Row vector points times a Maya matrix
+    return points.dot(matrix[:3, :3]) + matrix[3, :3]
+
+class JiggleMeshNode(oma.MPxDeformerNode):
+    """
+    Jiggles every vertex of the deformed geometry in world space, with the
+    damping/stiffness/jiggle update of JigglePoint. Points are read and written
+    through the iterator's bulk calls and vertices painted to zero weight are
+    not simulated.
+    """
+
+    TYPE_NAME = "jiggleMesh"
+    TYPE_ID = om.MTypeId(0x0007F7FB)
+
+    aTime = None
+    aDamping = None
+    aStiffness = None
+    aJiggleAmount = None
+
+    def __init__(self):
+        super(JiggleMeshNode, self).__init__()
+        # JiggleState and vertex weights per geometry index
+        self._states = {}
+        self._weights = {}
+
+    def setDependentsDirty(self, plug, affectedPlugs):
+        # Painting weights rereads them on the next evaluation
+        attribute = plug.attribute()
+        if attribute == oma.MPxDeformerNode.weights or attribute == oma.MPxDeformerNode.weightList:
+            self._weights.clear()
+
+    def vertexWeights(self, data, itGeo, geomIndex):
+        # Weights of the iterated vertices in iterator order, unpainted vertices weigh 1
+        count = itGeo.count()
+        weights = self._weights.get(geomIndex)
+        if weights is not None and len(weights) == count:
+            return weights
+
+        painted = {}
+        weight_list_handle = data.inputArrayValue(oma.MPxDeformerNode.weightList)  #type: om.MArrayDataHandle
+        try:
+            weight_list_handle.jumpToLogicalElement(geomIndex)
+            weights_handle = om.MArrayDataHandle(weight_list_handle.inputValue().child(oma.MPxDeformerNode.weights))
+            for physicalIndex in range(len(weights_handle)):
+                weights_handle.jumpToPhysicalElement(physicalIndex)
+                painted[weights_handle.elementLogicalIndex()] = weights_handle.inputValue().asFloat()
+        except RuntimeError:
+            pass
+
+        indices = []
+        itGeo.reset()
+        while not itGeo.isDone():
+            indices.append(itGeo.index())
+            itGeo.next()
+        itGeo.reset()
+        weights = np.array([painted.get(index, 1.0) for index in indices], dtype=np.float64)
+        self._weights[geomIndex] = weights
+        return weights
+
+    def deform(self, data, itGeo, localToWorldMatrix, geomIndex):
+        if np is None:
+            return
+
+        # Get the inputs
+        envelope = data.inputValue(oma.MPxDeformerNode.envelope).asFloat()
+        damping = data.inputValue(self.aDamping).asFloat()
+        stiffness = data.inputValue(self.aStiffness).asFloat()
+        jiggleAmount = data.inputValue(self.aJiggleAmount).asFloat()
+        currentTime = data.inputValue(self.aTime).asTime()
+
+        points = np.array(itGeo.allPositions(), dtype=np.float64)[:, :3]
+        toWorld = MatrixArray(localToWorldMatrix)
+        goal = TransformPoints(points, toWorld)
+
+        state = self._states.get(geomIndex)
+        if state is None or len(state) != len(goal):
+            state = JiggleState(goal)
+            state.time = currentTime.value
+            self._states[geomIndex] = state
+
+        # Check if the timestep is just 1 frame since we want a stable simulation
+        timeDifference = currentTime.value - state.time
+        if timeDifference > 1.0 or timeDifference < 0.0:
+            state.reset(goal)
+            state.time = currentTime.value
+            return
+
+        weights = self.vertexWeights(data, itGeo, geomIndex)
+        active = np.flatnonzero(weights > 0.0)
+        if len(active) == len(weights):
+            active = slice(None)
+        goal = goal[active]
+
+        # Re-evaluating the same frame, e.g. while painting weights, does not advance the jiggle
+        if timeDifference > 0.0:
+            position = state.step(goal, damping, stiffness, active)
+            state.time = currentTime.value
+        else:
+            position = state.current[active]
+
+        amount = (jiggleAmount * envelope) * weights[active]
+        position = goal + (position - goal) * amount[:, np.newaxis]
+
+        # Back to the local space of the geometry
+        points[active] = TransformPoints(position, np.linalg.inv(toWorld))
+        itGeo.setAllPositions(om.MPointArray(points.tolist()))
+
+    @classmethod
+    def creator(cls):
+        return JiggleMeshNode()
+
+    @classmethod
+    def initialize(cls):
+        numeric_attr = om.MFnNumericAttribute()
+        unit_attr = om.MFnUnitAttribute()
+        outputGeom = oma.MPxDeformerNode.outputGeom
+
+        cls.aTime = unit_attr.create('time', 'time', om.MFnUnitAttribute.kTime, 0.0)
+
+        cls.aJiggleAmount = numeric_attr.create('jiggle', 'jiggle', om.MFnNumericData.kFloat, 0.0)
+        numeric_attr.keyable = True
+        numeric_attr.setMin(0.0)
+        numeric_attr.setMax(1.0)
+
+        cls.aStiffness = numeric_attr.create('stiffness', 'stiffness', om.MFnNumericData.kFloat, 1.0)
+        numeric_attr.keyable = True
+        numeric_attr.setMin(0.0)
+        numeric_attr.setMax(1.0)
+
+        cls.aDamping = numeric_attr.create('damping', 'damping', om.MFnNumericData.kFloat, 1.0)
+        numeric_attr.keyable = True
+        numeric_attr.setMin(0.0)
+        numeric_attr.setMax(1.0)
+
+        cls.addAttribute(cls.aTime)
+        cls.addAttribute(cls.aJiggleAmount)
+        cls.addAttribute(cls.aStiffness)
+        cls.addAttribute(cls.aDamping)
+
+        cls.attributeAffects(cls.aTime, outputGeom)
+        cls.attributeAffects(cls.aJiggleAmount, outputGeom)
+        cls.attributeAffects(cls.aStiffness, outputGeom)
+        cls.attributeAffects(cls.aDamping, outputGeom)
+
+class JigglePointArrayNode(om.MPxNode):
+    """
+    Many jigglePoint nodes in one: goal[i], parentInverse[i] and per-element
+    stiffness[i], damping[i] and jiggle[i] drive output[i]. The state of every
+    element lives in one JiggleState and all outputs are written by one compute.
+    """
+
+    TYPE_NAME = "jigglePointArray"
+    TYPE_ID = om.MTypeId(0x0007F7FC)
+
+    aOutput = None
+    aGoal = None
+    aDamping = None
+    aStiffness = None
+    aTime = None
+    aParentInverse = None
+    aJiggleAmount = None
+
+    def __init__(self):
+        super(JigglePointArrayNode, self).__init__()
+        self._state = None
+        # Logical goal indices, in the row order of the state
+        self._indices = []
+
+    @staticmethod
+    def readElements(data, attribute, value):
+        # Logical index to value for the elements of an array attribute that exist
+        array_handle = data.inputArrayValue(attribute)  #type: om.MArrayDataHandle
+        elements = {}
+        for physicalIndex in range(len(array_handle)):
+            array_handle.jumpToPhysicalElement(physicalIndex)
+            elements[array_handle.elementLogicalIndex()] = value(array_handle.inputValue())
+        return elements
+
+    def elementValues(self, data, attribute, default):
+        # One (n, 1) row per goal, missing elements take the default
+        values = self.readElements(data, attribute, lambda handle: handle.asFloat())
+        return np.array([values.get(index, default) for index in self._indices])[:, np.newaxis]
+
+    def updateElements(self, indices, goal, currentTime):
+        # Elements that stay keep their motion, added ones start at rest on their goal
+        if indices == self._indices and self._state is not None:
+            return
+        state = JiggleState(goal)
+        state.time = currentTime.value
+        if self._state is not None:
+            rows = dict((index, row) for row, index in enumerate(self._indices))
+            kept = [(row, rows[index]) for row, index in enumerate(indices) if index in rows]
+            if kept:
+                new, old = np.array(kept).T
+                state.current[new] = self._state.current[old]
+                state.previous[new] = self._state.previous[old]
+                state.time = self._state.time
+        self._state = state
+        self._indices = indices
+
+    def compute(self, plug, data):
+        if plug.isElement:
+            plug = plug.array()
+        if plug != JigglePointArrayNode.aOutput or np is None:
+            return
+
+        # Get the inputs
+        goals = self.readElements(data, self.aGoal, lambda handle: tuple(handle.asFloatVector()))
+        currentTime = data.inputValue(self.aTime).asTime()
+        indices = sorted(goals)
+        goal = np.array([goals[index] for index in indices], dtype=np.float64).reshape(-1, 3)
+        self.updateElements(indices, goal, currentTime)
+        damping = self.elementValues(data, self.aDamping, 1.0)
+        stiffness = self.elementValues(data, self.aStiffness, 1.0)
+        jiggleAmount = self.elementValues(data, self.aJiggleAmount, 0.0)
+        matrices = self.readElements(data, self.aParentInverse, lambda handle: MatrixArray(handle.asMatrix()))
+        parentInverse = np.array([matrices.get(index, np.eye(4)) for index in indices]).reshape(-1, 4, 4)
+
+        # Check if the timestep is just 1 frame since we want a stable simulation
+        state = self._state
+        timeDifference = currentTime.value - state.time
+        if timeDifference > 1.0 or timeDifference < 0.0:
+            state.reset(goal)
+            state.time = currentTime.value
+        elif timeDifference > 0.0:
+            state.step(goal, damping, stiffness)
+            state.time = currentTime.value
+
+        newPosition = goal + (state.current - goal) * jiggleAmount
+
+        # Put each element in its output local space
+        newPosition = np.einsum('ni,nij->nj', np.hstack([newPosition, np.ones((len(newPosition), 1))]),
+                                parentInverse)
+
+        output_array_handle = data.outputArrayValue(JigglePointArrayNode.aOutput)  #type: om.MArrayDataHandle
+        builder = om.MArrayDataBuilder(data, JigglePointArrayNode.aOutput, len(indices))
+        for index, p in zip(indices, newPosition.tolist()):
+            builder.addElement(index).set3Float(p[0], p[1], p[2])
+        output_array_handle.set(builder)
+        output_array_handle.setAllClean()
+        data.setClean(plug)
+
+    @classmethod
+    def creator(cls):
+        return JigglePointArrayNode()
+
+    @classmethod
+    def initialize(cls):
+        numeric_attr = om.MFnNumericAttribute()
+        unit_attr = om.MFnUnitAttribute()
+        matrix_attr = om.MFnMatrixAttribute()
+
+        cls.aOutput = numeric_attr.createPoint('output', 'out')
+        numeric_attr.array = True
+        numeric_attr.writable = False
+        numeric_attr.storable = False
+        numeric_attr.usesArrayDataBuilder = True
+
+        cls.aJiggleAmount = numeric_attr.create('jiggle', 'jiggle', om.MFnNumericData.kFloat, 0.0)
+        numeric_attr.array = True
+        numeric_attr.keyable = True
+        numeric_attr.setMin(0.0)
+        numeric_attr.setMax(1.0)
+
+        cls.aGoal = numeric_attr.createPoint('goal', 'goal')
+        numeric_attr.array = True
+
+        cls.aTime = unit_attr.create('time', 'time', om.MFnUnitAttribute.kTime, 0.0)
+
+        cls.aStiffness = numeric_attr.create('stiffness', 'stiffness', om.MFnNumericData.kFloat, 1.0)
+        numeric_attr.array = True
+        numeric_attr.keyable = True
+        numeric_attr.setMin(0.0)
+        numeric_attr.setMax(1.0)
+
+        cls.aDamping = numeric_attr.create('damping', 'damping', om.MFnNumericData.kFloat, 1.0)
+        numeric_attr.array = True
+        numeric_attr.keyable = True
+        numeric_attr.setMin(0.0)
+        numeric_attr.setMax(1.0)
+
+        cls.aParentInverse = matrix_attr.create('parentInverse', 'parentInverse')
+        matrix_attr.array = True
+
+        for attribute in (cls.aOutput, cls.aJiggleAmount, cls.aGoal, cls.aTime, cls.aStiffness, cls.aDamping,
+                          cls.aParentInverse):
+            cls.addAttribute(attribute)
+        for attribute in (cls.aJiggleAmount, cls.aGoal, cls.aTime, cls.aStiffness, cls.aDamping, cls.aParentInverse):
+            cls.attributeAffects(attribute, cls.aOutput)
+
+def initializePlugin(plugin):
+    vecdor = "Xicheng"
+    version = "1.0.0"
+
+    fnPlugin = om.MFnPlugin(plugin, vecdor, version, 'Any')
+    if np is None:
+        om.MGlobal.displayWarning("{0} and {1} need NumPy and do nothing without it".format(
+            JiggleMeshNode.TYPE_NAME, JigglePointArrayNode.TYPE_NAME))
+    try:
+        fnPlugin.registerNode(JiggleMeshNode.TYPE_NAME,
+                              JiggleMeshNode.TYPE_ID,
+                              JiggleMeshNode.creator,
+                              JiggleMeshNode.initialize,
+                              om.MPxNode.kDeformerNode)
+    except:
+        om.MGlobal.displayError("Failed to register node: {0}".format(JiggleMeshNode.TYPE_NAME))
+    try:
+        fnPlugin.registerNode(JigglePointArrayNode.TYPE_NAME,
+                              JigglePointArrayNode.TYPE_ID,
+                              JigglePointArrayNode.creator,
+                              JigglePointArrayNode.initialize,
+                              om.MPxNode.kDependNode)
+    except:
+        om.MGlobal.displayError("Failed to register node: {0}".format(JigglePointArrayNode.TYPE_NAME))
+
+def uninitializePlugin(plugin):
+    fnPlugin = om.MFnPlugin(plugin)
+    try:
+        fnPlugin.deregisterNode(JiggleMeshNode.TYPE_ID)
+    except:
+        om.MGlobal.displayError("Failed to deregister node: {0}".format(JiggleMeshNode.TYPE_NAME))
+    try:
+        fnPlugin.deregisterNode(JigglePointArrayNode.TYPE_ID)
+    except:
+        om.MGlobal.displayError("Failed to deregister node: {0}".format(JigglePointArrayNode.TYPE_NAME))
+
+if __name__ == "__main__":
+    """
+    For Development Only
+    """
+    # Any code required before unloading the plug-in (e.g. creating a new scene)
+    cmds.file(new=True, force=True)
+
+    # Reload the plugin
+    plugin_name = "jiggle_node.py"
+
+    cmds.evalDeferred('if cmds.pluginInfo("{0}", q=True, loaded=True): cmds.unloadPlugin("{0}")'.format(plugin_name))
+    cmds.evalDeferred('if not cmds.pluginInfo("{0}", q=True, loaded=True): cmds.loadPlugin("{0}")'.format(plugin_name))
+
+    # Any setup code to help speed up testing (e.g. loading a test scene)
+    # cmds.evalDeferred('cmds.polySphere(); cmds.deformer(type="jiggleMesh")')
+
+    # Connect outTime to time attribute
+    # cmds.evalDeferred('cmds.connectAttr("time1.outTime", "jiggleMesh1.time", f=True)')
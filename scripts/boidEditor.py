@@ -36,6 +36,7 @@ class TestDialog(QtWidgets.QDialog):
         self.create_boids_btn = QtWidgets.QPushButton("Create Boids")
         self.connect_boids_btn = QtWidgets.QPushButton("Connect Boids")
         self.setup_boids_btn = QtWidgets.QPushButton("Setup Boids")
+        self.connect_instancer_btn = QtWidgets.QPushButton("Connect Instancer")
         self.ok_btn = QtWidgets.QPushButton("OK")
         self.cancel_btn = QtWidgets.QPushButton("Cancel")
         
@@ -47,6 +48,7 @@ class TestDialog(QtWidgets.QDialog):
         function_layout.addWidget(self.create_boids_btn)
         function_layout.addWidget(self.connect_boids_btn)
         function_layout.addWidget(self.setup_boids_btn)
+        function_layout.addWidget(self.connect_instancer_btn)
 
         button_layout = QtWidgets.QHBoxLayout()
         button_layout.addStretch()
@@ -66,6 +68,8 @@ class TestDialog(QtWidgets.QDialog):
 
         self.setup_boids_btn.clicked.connect(self.setup_boids)
 
+        self.connect_instancer_btn.clicked.connect(self.connect_instancer)
+
         self.cancel_btn.clicked.connect(self.close)
 
     def reload_plugin(self):
@@ -108,6 +112,15 @@ class TestDialog(QtWidgets.QDialog):
         locator = cmds.spaceLocator()
         cmds.connectAttr(locator[0] + ".translate", "boidnode1.goal", f=True)
 
+    def connect_instancer(self):
+        # Instance the selected objects on every boid through a single connection
+        items = cmds.ls(selection=True)
+
+        instancer = cmds.createNode("instancer")
+        for it in xrange(len(items)):
+            cmds.connectAttr(items[it] + ".matrix", "%s.inputHierarchy[%s]" % (instancer, it), f=True)
+        cmds.connectAttr("boidnode1.instanceData", instancer + ".inputPoints", f=True)
+
 try:
     test_dialog.close() # pylint: disable=E0601
     test_dialog.deleteLater()
@@ -8,6 +8,11 @@ import maya.OpenMayaUI as omui
 import maya.cmds as cmds
 import random
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 def maya_main_window():
     main_window_ptr = omui.MQtUtil.mainWindow()
     return wrapInstance(long(main_window_ptr), QtWidgets.QWidget)
@@ -92,10 +97,20 @@ class TestDialog(QtWidgets.QDialog):
     def connect_CD(self):
         items = cmds.ls(selection=True)
 
+        if numpy is None:
+            # Without NumPy a gravitynode only simulates one particle, so one node per item
+            for it in xrange(len(items)):
+                node = cmds.createNode("gravitynode")
+                cmds.connectAttr("time1.outTime", node + ".time", f=True)
+                cmds.connectAttr(node + ".translate", items[it] + ".translate", f=True)
+            return
+
+        # One node simulates every selected item, one particle each
+        node = cmds.createNode("gravitynode")
+        cmds.setAttr(node + ".particleCount", len(items))
+        cmds.connectAttr("time1.outTime", node + ".time", f=True)
         for it in xrange(len(items)):
-            cmds.createNode("gravitynode")
-            cmds.connectAttr("time1.outTime", "gravitynode%s.time" % (it+1), f=True)
-            cmds.connectAttr("gravitynode%s.translate" % (it+1), items[it] + ".translate", f=True)
+            cmds.connectAttr("%s.output[%s]" % (node, it), items[it] + ".translate", f=True)
 
 
 try: